@@ -1,17 +1,27 @@
 import os
 import sys
 from pathlib import Path
+from time import perf_counter
 
-from PySide2.QtWidgets import QApplication
+# the startup profile times the imports below (Qt and the window take most of the startup)
+T0 = perf_counter()
 
-from pokecon.window import Window
+from PySide2.QtWidgets import QApplication  # noqa: E402
+
+from pokecon.logger import setup_logging  # noqa: E402
+from pokecon.profiler import StartupProfile  # noqa: E402
+from pokecon.window import Window  # noqa: E402
 
 
 def main():
+    profile = StartupProfile('--startup-profile' in sys.argv, origin=T0)
+    profile.add('import', T0, perf_counter())
+    setup_logging()
     root = Path(sys.argv[0]).parent
     sys.path.append(str(root))
-    app = QApplication(sys.argv)
-    w = Window(root)
+    with profile.phase('qapplication'):
+        app = QApplication(sys.argv)
+    w = Window(root, profile)
     w.show()
     sys.exit(app.exec_())
 
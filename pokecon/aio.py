@@ -0,0 +1,228 @@
+import asyncio
+
+from pokecon import metrics
+from pokecon.command import ImageProcPythonCommand, PythonCommand
+from pokecon.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+
+# Python command whose `do` is a coroutine, run on its own event loop on the script thread.
+# Watchers and input sequences can run concurrently as tasks, stopping cancels the main task
+# and every task still running, so waits raise asyncio.CancelledError as usual
+# asyncioでdoを書くコマンド(複数の監視や入力を同時に実行できます)
+#
+#   async def do(self):
+#       error = asyncio.create_task(self.wait_for_template('error.png'))
+#       await self.press(Button.A)
+#       ...
+class AsyncPythonCommand(PythonCommand):
+    def __init__(self, *args):
+        super().__init__(*args)
+        self.loop = None
+        self.main = None
+
+    async def do(self):
+        pass
+
+    def do_safe(self):
+        self.loop = asyncio.new_event_loop()
+        try:
+            self.loop.run_until_complete(self.run())
+            logger.info('-- finished successfully. --')
+        except asyncio.CancelledError:
+            logger.info('-- finished successfully. --')
+        except Exception as e:
+            metrics.script_exceptions.inc(1, self.NAME, type(e).__name__)
+            logger.error(e, exc_info=True)
+        finally:
+            self.close_loop()
+            self.alive = False
+            self.cleanup()
+
+    async def run(self):
+        self.main = asyncio.current_task()
+        if self.alive:
+            await self.do()
+
+    # tasks left running by the script are cancelled too
+    @staticmethod
+    async def cancel_tasks():
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close_loop(self):
+        self.loop.run_until_complete(self.cancel_tasks())
+        self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+        self.loop.close()
+        self.loop = None
+        self.main = None
+
+    # called from any thread
+    def end(self):
+        if self.alive:
+            logger.info('-- sent a stop request. --')
+        self.alive = False
+        loop, main = self.loop, self.main
+        if loop is not None and main is not None:
+            try:
+                loop.call_soon_threadsafe(main.cancel)
+            except RuntimeError:
+                # the loop is already closed
+                pass
+
+    async def press(self, buttons, duration=0.1, wait=0.1):
+        self.input.press(buttons)
+        await self.wait(duration)
+        self.input.press_end(buttons)
+        await self.wait(wait)
+
+    async def press_rep(self, buttons, repeat: int, duration=0.1, interval=0.1, wait=0.1):
+        for i in range(0, repeat):
+            await self.press(buttons, duration, 0 if i == repeat - 1 else interval)
+        await self.wait(wait)
+
+    async def hold(self, buttons, wait=0.1):
+        self.input.hold(buttons)
+        await self.wait(wait)
+
+    async def hold_end(self, buttons):
+        self.input.hold_end(buttons)
+
+    async def tilt(self, stick, degree, magnitude=1.0, duration=0.1, wait=0.1):
+        self.input.tilt(stick, degree, magnitude)
+        await self.wait(duration)
+        self.input.center(stick)
+        await self.wait(wait)
+
+    async def wait(self, wait=0.1):
+        metrics.script_iterations.inc(1, self.NAME)
+        await self.clock.sleep_async(wait)
+
+    async def wait_for_sound(self, name, timeout=None):
+        if self.sound is None:
+            raise RuntimeError('Sound detector is not available')
+        since = self.sound.hits[name]
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        # waited in slices, so that a cancelled wait does not leave a blocked worker thread
+        while True:
+            remaining = 0.1 if deadline is None else min(deadline - loop.time(), 0.1)
+            if remaining <= 0:
+                return False
+            if await loop.run_in_executor(None, self.sound.wait_for, name, remaining, since):
+                return True
+
+
+# Async command with frames, concurrent awaits of next_frame share one capture read
+class AsyncImageProcPythonCommand(AsyncPythonCommand, ImageProcPythonCommand):
+    def __init__(self, cap):
+        super().__init__(cap)
+        self.reading = None
+
+    def do_safe(self):
+        self.prepare()
+        AsyncPythonCommand.do_safe(self)
+
+    def close_loop(self):
+        super().close_loop()
+        self.reading = None
+
+    # the FrameMemo of the next frame, read on a worker thread
+    async def next_frame(self):
+        if self.reading is None:
+            self.reading = asyncio.get_running_loop().run_in_executor(None, self.read_memo)
+            self.reading.add_done_callback(self.done_reading)
+        return await asyncio.shield(self.reading)
+
+    def done_reading(self, future):
+        if future is self.reading:
+            self.reading = None
+
+    def read_memo(self):
+        memo = self.frames.read(self.cap)
+        self.frame_clock.observe(memo.timestamp)
+        return memo
+
+    # template matching on the next frame, matching runs on a worker thread (cv2 releases the GIL)
+    async def is_contain_template(self, template_path, threshold=0.7, use_gray=True, show_value=False, area=None,
+                                  tmpl_area=None, band=0):
+        memo = await self.next_frame()
+        # a concurrent next_frame replaces the memo and releases its buffer, the check keeps its own reference.
+        # Shielded, so that the reference is released by the worker even if this task is cancelled
+        buffer = memo.hold()
+        return await asyncio.shield(asyncio.get_running_loop().run_in_executor(
+            None, self.check_held, buffer, memo, template_path, threshold, use_gray, show_value, area, tmpl_area,
+            band))
+
+    def check_held(self, buffer, memo, *args):
+        try:
+            return self.check_template(memo, *args)
+        finally:
+            if buffer is not None:
+                buffer.release()
+
+    # watch frames until the template is shown, returns False on timeout
+    async def wait_for_template(self, template_path, timeout=None, **kwargs):
+        try:
+            await asyncio.wait_for(self.until_template(template_path, **kwargs), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    async def until_template(self, template_path, **kwargs):
+        while not await self.is_contain_template(template_path, **kwargs):
+            pass
+
+    # run_at_frame without blocking the other tasks, the loop sleeps until shortly before the deadline
+    # and a worker thread the precise rest, the action runs on the loop thread like every other input
+    async def run_at_frame(self, action, frames, base=None, area=None):
+        base, target, deadline = self.frame_deadline(frames, base)
+        probe = self.frame_probe(area)
+        try:
+            loop = asyncio.get_running_loop()
+            if deadline - self.clock.time() > 0.1:
+                await self.clock.sleep_async(deadline - self.clock.time() - 0.05)
+            if probe is not None:
+                await self.arm_probe(probe)
+            self.warn_late(base, frames, deadline)
+            await loop.run_in_executor(None, self.clock.sleep_until, deadline)
+            started = self.clock.time()
+            action()
+            written = self.clock.time()
+            hit = None
+            if probe is not None:
+                hit = await self.wait_probe(probe, max(target - written, 0) + self.latency.reaction())
+        finally:
+            self.remove_probe(probe)
+        return self.frame_timing(base, frames, started, written, probe, hit)
+
+    async def press_at_frame(self, buttons, frames, base=None, duration=0.1, wait=0.1, area=None):
+        timing = await self.run_at_frame(lambda: self.input.press(buttons), frames, base, area)
+        await self.wait(max(timing.written + duration - self.clock.time(), 0))
+        self.input.press_end(buttons)
+        await self.wait(wait)
+        return timing
+
+    async def arm_probe(self, probe):
+        if not hasattr(self.cap, 'add_sink'):
+            self.publish_memo(probe, await self.next_frame())
+        return probe.arm(self.clock.time())
+
+    # captures with sinks feed the probe on their own thread, the others are read here
+    async def wait_probe(self, probe, timeout):
+        deadline = self.clock.time() + timeout
+        while probe.changed_frame() is None and self.clock.time() < deadline:
+            if hasattr(self.cap, 'add_sink'):
+                await self.clock.sleep_async(self.frame_clock.nominal)
+            else:
+                self.publish_memo(probe, await self.next_frame())
+        return probe.wait(0)
+
+    @staticmethod
+    def publish_memo(probe, memo):
+        if memo.frame is not None:
+            probe.publish(memo.frame_id, memo.timestamp, memo.frame)
@@ -0,0 +1,236 @@
+import mmap
+import queue
+import struct
+import threading
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from pokecon.logger import get_logger
+
+
+MAGIC = b'PCAR'
+VERSION = 1
+# magic, version, codec, channels, width, height, quality, keyframe interval
+HEADER = struct.Struct('<4sHBBIIII')
+HEADER_SIZE = 64
+INDEX_DTYPE = np.dtype([
+    ('frame_id', '<i8'),
+    ('timestamp', '<f8'),
+    ('offset', '<u8'),
+    ('length', '<u4'),
+    ('kind', '<u4'),
+    # row of the keyframe a delta frame is based on
+    ('key', '<i8'),
+])
+CODECS = ['jpeg', 'delta']
+KEY = 0
+DELTA = 1
+
+
+logger = get_logger(__name__)
+
+
+def index_path(path):
+    path = Path(path)
+    return path.with_name(path.name + '.idx')
+
+
+# Writes frames to an archive on a background thread.
+#   jpeg:  every frame is a JPEG
+#   delta: lossless, every `keyframe_interval` frames is a keyframe and the others are
+#          the difference to that keyframe, both compressed with zlib
+# A side index keeps frame id -> timestamp -> byte offset so that frames can be read randomly.
+# Compression runs on `workers` threads (cv2 and zlib release the GIL) and is written in order
+# 録画したフレームをアーカイブに書き込みます
+class ArchiveWriter:
+    def __init__(self, path, codec='jpeg', gray=False, scale=1.0, quality=90, keyframe_interval=60,
+                 queue_size=120, workers=2):
+        if codec not in CODECS:
+            raise ValueError(f'unknown codec: {codec}')
+        self.path = Path(path)
+        self.codec = codec
+        self.gray = gray
+        self.scale = scale
+        self.quality = quality
+        self.keyframe_interval = keyframe_interval
+        self.queue = queue.Queue(queue_size)
+        self.dropped = 0
+        # frames of another size than the first one, the header holds a single size
+        self.rejected = 0
+        self.shape = None
+        self.written = 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.data = open(self.path, 'wb')
+        self.index = open(index_path(self.path), 'wb')
+        self.offset = HEADER_SIZE
+        self.rows = 0
+        self.keyframe = None
+        self.key_row = -1
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(workers)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    # NOTE: called on the capture thread, so encoding is left to the writer thread
+    def write(self, frame_id, timestamp, frame):
+        try:
+            self.queue.put_nowait((frame_id, timestamp, frame.copy()))
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.pool.shutdown()
+        self.data.close()
+        self.index.close()
+        if self.written == 0:
+            # an archive without a header cannot be read, so nothing is left behind
+            self.path.unlink()
+            index_path(self.path).unlink()
+            logger.info(f'no frames were recorded, removed {self.path.name}')
+            return
+        logger.info(f'saved {self.written} frames to {self.path.name} '
+                    f'(dropped: {self.dropped}, rejected: {self.rejected})')
+
+    def preprocess(self, frame):
+        if self.scale != 1.0:
+            frame = cv2.resize(frame, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        if self.gray:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return frame
+
+    def write_header(self, frame):
+        channels = 1 if frame.ndim == 2 else frame.shape[2]
+        header = HEADER.pack(MAGIC, VERSION, CODECS.index(self.codec), channels,
+                             frame.shape[1], frame.shape[0], self.quality, self.keyframe_interval)
+        self.data.write(header.ljust(HEADER_SIZE, b'\0'))
+
+    # decide the kind of the frame and the image to compress, in frame order
+    def prepare(self, frame):
+        if self.codec == 'jpeg':
+            return KEY, self.rows, frame
+        if self.keyframe is None or (self.rows - self.key_row) >= self.keyframe_interval:
+            self.keyframe = frame
+            self.key_row = self.rows
+            return KEY, self.rows, frame
+        # uint8 subtraction wraps around, so adding the keyframe back restores the frame exactly
+        return DELTA, self.key_row, np.subtract(frame, self.keyframe)
+
+    def compress(self, image):
+        if self.codec == 'jpeg':
+            _, buf = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            return buf.tobytes()
+        return zlib.compress(image.tobytes(), 1)
+
+    def flush(self, item):
+        frame_id, timestamp, kind, key, future = item
+        blob = future.result()
+        self.data.write(blob)
+        row = np.array([(frame_id, timestamp, self.offset, len(blob), kind, key)], dtype=INDEX_DTYPE)
+        self.index.write(row.tobytes())
+        self.offset += len(blob)
+        self.written += 1
+
+    def run(self):
+        pending = deque()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            frame_id, timestamp, frame = item
+            frame = self.preprocess(frame)
+            if self.rows == 0:
+                self.write_header(frame)
+                self.shape = frame.shape
+            elif frame.shape != self.shape:
+                if self.rejected == 0:
+                    logger.warning(f'capture size changed to {frame.shape[1]}x{frame.shape[0]}, '
+                                   f'the frames are not recorded (start a new recording)')
+                self.rejected += 1
+                continue
+            kind, key, image = self.prepare(frame)
+            pending.append((frame_id, timestamp, kind, key, self.pool.submit(self.compress, image)))
+            self.rows += 1
+            while pending and (pending[0][-1].done() or len(pending) > self.workers * 2):
+                self.flush(pending.popleft())
+        while pending:
+            self.flush(pending.popleft())
+
+
+# Reads frames of an archive by frame id or by row, the data file is memory-mapped
+# アーカイブからフレームを読み込みます
+class ArchiveReader:
+    def __init__(self, path):
+        self.path = Path(path)
+        if self.path.stat().st_size < HEADER_SIZE:
+            raise ValueError(f'empty archive: {self.path}')
+        self.file = open(self.path, 'rb')
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, codec, self.channels, self.w, self.h, self.quality, self.keyframe_interval = \
+            HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'not an archive: {self.path}')
+        self.codec = CODECS[codec]
+        self.index = np.fromfile(index_path(self.path), dtype=INDEX_DTYPE)
+        self.key_row = -1
+        self.keyframe = None
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def fps(self):
+        if len(self.index) < 2:
+            return 60
+        return (len(self.index) - 1) / (self.index['timestamp'][-1] - self.index['timestamp'][0])
+
+    def shape(self):
+        return (self.h, self.w) if self.channels == 1 else (self.h, self.w, self.channels)
+
+    def blob(self, row):
+        return np.frombuffer(self.mm, np.uint8, count=int(self.index['length'][row]),
+                             offset=int(self.index['offset'][row]))
+
+    def decode_raw(self, row):
+        return np.frombuffer(zlib.decompress(self.blob(row)), np.uint8).reshape(self.shape())
+
+    def read(self, row):
+        if self.codec == 'jpeg':
+            flag = cv2.IMREAD_GRAYSCALE if self.channels == 1 else cv2.IMREAD_COLOR
+            return cv2.imdecode(self.blob(row), flag)
+        if self.index['kind'][row] == KEY:
+            return self.decode_raw(row).copy()
+        key = int(self.index['key'][row])
+        if key != self.key_row:
+            self.keyframe = self.decode_raw(key)
+            self.key_row = key
+        return np.add(self.decode_raw(row), self.keyframe)
+
+    # row of the frame id, or None if the frame was not recorded
+    def find(self, frame_id):
+        ids = self.index['frame_id']
+        row = int(np.searchsorted(ids, frame_id))
+        if row < len(ids) and ids[row] == frame_id:
+            return row
+        return None
+
+    # row of the last frame at or before the timestamp
+    def find_time(self, timestamp):
+        return max(int(np.searchsorted(self.index['timestamp'], timestamp, side='right')) - 1, 0)
+
+    def get(self, frame_id):
+        row = self.find(frame_id)
+        return None if row is None else self.read(row)
+
+    def frame_info(self, row):
+        return int(self.index['frame_id'][row]), float(self.index['timestamp'][row])
+
+    def close(self):
+        self.mm.close()
+        self.file.close()
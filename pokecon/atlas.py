@@ -0,0 +1,195 @@
+# Pack the templates into one preprocessed file, opened with mmap by every process
+#
+#   python -m pokecon.atlas [--templates DIR] [--scales 1.0,0.6667,0.5]
+#
+# The atlas holds the gray and colour images of every PNG in templates/ at the capture scales,
+# and the crops listed in templates/crops.csv (columns `template,x1,x2,y1,y2` at 1920x1080).
+# It is rebuilt when it is opened and a PNG is newer, so running this is only needed to build it ahead
+# テンプレートを前処理して1つのファイルにまとめ、mmapで共有します
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import mmap
+import os
+import struct
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from pokecon.logger import get_logger, setup_logging
+
+
+# the name has a digest of the sources, so that a rebuilt atlas never replaces one which is mapped
+ATLAS_PREFIX = '.atlas-'
+MAGIC = b'PCATLAS1'
+ALIGN = 64
+# 1920x1080 (reference), 1280x720 and 960x540 captures
+SCALES = (1.0, 0.6667, 0.5)
+
+
+logger = get_logger(__name__)
+
+
+def template_key(template_path):
+    return Path(template_path).as_posix()
+
+
+def _sources(path_dir):
+    return {template_key(p.relative_to(path_dir)): p.stat().st_mtime_ns for p in sorted(path_dir.rglob('*.png'))}
+
+
+def read_crops(path_dir):
+    crops = {}
+    path = path_dir.joinpath('crops.csv')
+    if path.exists():
+        with open(path, encoding='utf-8', newline='') as f:
+            for row in csv.DictReader(f):
+                crops.setdefault(template_key(row['template']), []).append(
+                    tuple(int(row[k]) for k in ('x1', 'x2', 'y1', 'y2')))
+    return crops
+
+
+# .atlas-<digest of the PNGs and crops.csv> in path_dir
+def atlas_path(path_dir):
+    path_dir = Path(path_dir)
+    crops = path_dir.joinpath('crops.csv')
+    key = json.dumps([_sources(path_dir), crops.stat().st_mtime_ns if crops.exists() else None])
+    return path_dir.joinpath(ATLAS_PREFIX + hashlib.sha1(key.encode('utf-8')).hexdigest()[:16])
+
+
+# the atlas is stale if a PNG was added, removed or modified after it was built
+def is_stale(path_dir):
+    return not atlas_path(path_dir).exists()
+
+
+def _read_index(f):
+    head = f.read(len(MAGIC) + 8)
+    if len(head) < len(MAGIC) + 8 or head[:len(MAGIC)] != MAGIC:
+        raise ValueError('not a template atlas')
+    length, = struct.unpack('<Q', head[len(MAGIC):])
+    return json.loads(f.read(length).decode('utf-8'))
+
+
+def _resize(image, scale):
+    if scale == 1.0:
+        return image
+    w, h = max(int(round(image.shape[1] * scale)), 1), max(int(round(image.shape[0] * scale)), 1)
+    return cv2.resize(image, (w, h), interpolation=cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LINEAR)
+
+
+# Build the atlas of the templates in path_dir, written to a temporary file and renamed into place.
+# Atlases of older sources are removed, except those still mapped by a process on Windows
+def build_atlas(path_dir, path=None, scales=SCALES):
+    path_dir = Path(path_dir)
+    path = Path(path) if path else atlas_path(path_dir)
+    sources = _sources(path_dir)
+    crops = read_crops(path_dir)
+    entries, blobs, offset = [], [], 0
+    for name in sources:
+        for gray in (True, False):
+            original = cv2.imread(str(path_dir / name), cv2.IMREAD_GRAYSCALE if gray else cv2.IMREAD_COLOR)
+            if original is None:
+                logger.warning(f'atlas: cannot read {name}')
+                continue
+            for area in [None] + crops.get(name, []):
+                image = original if area is None else original[area[2]:area[3], area[0]:area[1]]
+                for scale in scales:
+                    scaled = np.ascontiguousarray(_resize(image, scale))
+                    entries.append([name, gray, list(area) if area else None, scale, offset, list(scaled.shape)])
+                    blobs.append(scaled)
+                    offset += -(-scaled.nbytes // ALIGN) * ALIGN
+    index = json.dumps({'sources': sources, 'entries': entries}).encode('utf-8')
+    start = -(-(len(MAGIC) + 8 + len(index)) // ALIGN) * ALIGN
+    temp = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+    try:
+        with open(temp, 'wb') as f:
+            f.write(MAGIC + struct.pack('<Q', len(index)) + index)
+            for entry, blob in zip(entries, blobs):
+                f.seek(start + entry[4])
+                f.write(blob.tobytes())
+            f.truncate(start + offset)
+        try:
+            os.replace(temp, path)
+        except PermissionError:
+            # another process built the same atlas first and has it mapped (Windows)
+            if not path.exists():
+                raise
+    finally:
+        if temp.exists():
+            temp.unlink()
+    logger.info(f'atlas: {len(entries)} images of {len(sources)} templates ({start + offset} bytes)')
+    remove_old(path_dir, path)
+    return path
+
+
+# atlases of other sources, and temporary files left by crashed builds
+def remove_old(path_dir, current):
+    for p in Path(path_dir).glob(ATLAS_PREFIX + '*'):
+        if p == current or (p.suffix == '.tmp' and time.time() - p.stat().st_mtime < 3600):
+            continue
+        try:
+            p.unlink()
+        except OSError:
+            # still mapped by a process, removed by a later build
+            pass
+
+
+# Read-only, memory-mapped atlas, the images are views into the mapping shared through the page cache
+# テンプレートのアトラス(mmapで開きます)
+class TemplateAtlas:
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path, 'rb') as f:
+            index = _read_index(f)
+            self.start = -(-f.tell() // ALIGN) * ALIGN
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.entries = {}
+        for name, gray, area, scale, offset, shape in index['entries']:
+            self.entries[name, gray, tuple(area) if area else None, round(scale, 4)] = (offset, tuple(shape))
+
+    # the image or None if the atlas does not have it
+    def get(self, template_path, gray, tmpl_area=None, scale=1.0):
+        entry = self.entries.get((template_key(template_path), gray, tuple(tmpl_area) if tmpl_area else None,
+                                  round(scale, 4)))
+        if entry is None:
+            return None
+        offset, shape = entry
+        return np.frombuffer(self.map, np.uint8, int(np.prod(shape)), self.start + offset).reshape(shape)
+
+    def close(self):
+        self.entries = {}
+        try:
+            self.map.close()
+        except BufferError:
+            # images are still referred, the mapping is released with them
+            pass
+
+
+# open the atlas of path_dir, rebuilt first if stale, or None if it cannot be built
+def open_atlas(path_dir):
+    try:
+        path = atlas_path(path_dir)
+        if not path.exists():
+            build_atlas(path_dir, path)
+        return TemplateAtlas(path)
+    except (OSError, ValueError):
+        logger.warning('atlas: not available, templates are read from the PNGs', exc_info=True)
+        return None
+
+
+def main():
+    setup_logging(logging.INFO)
+    from pokecon.template import TEMPLATE_PATH
+    parser = argparse.ArgumentParser(description='Pack the templates into a memory-mapped atlas')
+    parser.add_argument('--templates', default=str(TEMPLATE_PATH), help='template directory')
+    parser.add_argument('--scales', default=','.join(str(s) for s in SCALES), help='comma separated scales')
+    args = parser.parse_args()
+    build_atlas(args.templates, scales=[float(s) for s in args.scales.split(',')])
+
+
+if __name__ == '__main__':
+    main()
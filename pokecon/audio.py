@@ -0,0 +1,164 @@
+import multiprocessing
+
+from pokecon.config import AudioConfig
+from pokecon.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+
+# NOTE: 0 lets PortAudio choose the buffer size, -1 selects the default device
+def _stream_kwargs(config: AudioConfig):
+    import pyaudio
+    kwargs = dict(
+        format=pyaudio.paInt16,
+        channels=config.channels,
+        rate=config.rate,
+        input=True,
+        output=True,
+        frames_per_buffer=config.frames_per_buffer,
+    )
+    if config.input_device >= 0:
+        kwargs['input_device_index'] = config.input_device
+    if config.output_device >= 0:
+        kwargs['output_device_index'] = config.output_device
+    return kwargs
+
+
+# Loop audio back in a child process with blocking reads and writes,
+# so that no Python callback competes with the GUI and scripts for the GIL
+# GILの競合を避けるため、子プロセスで音声を入力から出力へ流します
+def _passthrough_process(config: AudioConfig, stop, stats):
+    import pyaudio
+    p = pyaudio.PyAudio()
+    kwargs = _stream_kwargs(config)
+    if kwargs['frames_per_buffer'] <= 0:
+        kwargs['frames_per_buffer'] = 1024
+    n = kwargs['frames_per_buffer']
+    stream = p.open(**kwargs)
+    stats[0] = stream.get_input_latency() + stream.get_output_latency() + n / config.rate
+    try:
+        while not stop.is_set():
+            try:
+                data = stream.read(n, exception_on_overflow=True)
+            except IOError:
+                stats[2] += 1
+                continue
+            try:
+                stream.write(data, exception_on_underflow=True)
+            except IOError:
+                stats[1] += 1
+    finally:
+        stream.stop_stream()
+        stream.close()
+        p.terminate()
+
+
+# Passes the capture card audio through to the speakers
+# キャプチャーボードの音声をスピーカーに出力します
+class AudioPassthrough:
+    def __init__(self, config: AudioConfig, sound=None):
+        self.config = config
+        self.sound = sound
+        self.p = None
+        self.stream = None
+        self.process = None
+        self.stop_event = None
+        # latency[s], underruns, overflows
+        self.stats = None
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.callbacks = 0
+        if config.mode == 'process' and sound is not None:
+            logger.warning('Sound detection is not available in the process audio mode')
+
+    def initialize(self):
+        if self.config.mode != 'process' and self.p is None:
+            import pyaudio
+            self.p = pyaudio.PyAudio()
+
+    def is_active(self):
+        return self.stream is not None or self.process is not None
+
+    def start(self):
+        if self.is_active():
+            return
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.callbacks = 0
+        if self.config.mode == 'process':
+            self.stop_event = multiprocessing.Event()
+            self.stats = multiprocessing.Array('d', 3)
+            self.process = multiprocessing.Process(target=_passthrough_process,
+                                                   args=(self.config, self.stop_event, self.stats),
+                                                   daemon=True)
+            self.process.start()
+        else:
+            self.initialize()
+            self.stats = [0.0, 0, 0]
+            self.stream = self.p.open(stream_callback=self.callback, **_stream_kwargs(self.config))
+            self.stream.start_stream()
+
+    def callback(self, input_data, frame_count, time_info, status):
+        import pyaudio
+        if status:
+            if status & pyaudio.paOutputUnderflow:
+                self.stats[1] += 1
+            if status & pyaudio.paInputOverflow:
+                self.stats[2] += 1
+        # time from the ADC of the first input sample to the DAC of the first output sample
+        latency = time_info['output_buffer_dac_time'] - time_info['input_buffer_adc_time']
+        self.latency_sum += latency
+        if latency > self.latency_max:
+            self.latency_max = latency
+        self.callbacks += 1
+        # the detector only copies the samples here, detection runs on its own thread
+        if self.sound is not None:
+            self.sound.feed(input_data)
+        return input_data, pyaudio.paContinue
+
+    def stop(self):
+        if not self.is_active():
+            return
+        self.report()
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
+        if self.process is not None:
+            self.stop_event.set()
+            self.process.join(1.0)
+            if self.process.is_alive():
+                self.process.kill()
+            self.process = None
+
+    def terminate(self):
+        self.stop()
+        if self.p is not None:
+            self.p.terminate()
+            self.p = None
+
+    # Return the achieved input-to-output latency and the number of underruns and overflows
+    def report(self):
+        if self.stats is None:
+            return None
+        if self.stream is not None:
+            reported = self.stream.get_input_latency() + self.stream.get_output_latency()
+            # some host APIs do not fill the timestamps, fall back to the reported latency
+            latency = self.latency_sum / self.callbacks if self.latency_max > 0 else reported
+            latency_max = self.latency_max if self.latency_max > 0 else reported
+        else:
+            latency = latency_max = self.stats[0]
+        result = {
+            'mode': self.config.mode,
+            'rate': self.config.rate,
+            'frames_per_buffer': self.config.frames_per_buffer,
+            'latency': latency,
+            'latency_max': latency_max,
+            'underruns': int(self.stats[1]),
+            'overflows': int(self.stats[2]),
+        }
+        logger.info(f'audio {result["mode"]}: latency {latency * 1000:.1f} ms '
+                    f'(max {latency_max * 1000:.1f} ms), '
+                    f'underruns {result["underruns"]}, overflows {result["overflows"]}')
+        return result
@@ -0,0 +1,233 @@
+# Calibrate template thresholds on labelled frames
+#
+#   python -m pokecon.calibration CORPUS [--labels labels.csv] [--areas areas.csv] [--workers N]
+#
+# CORPUS is a directory of screenshots or a recorded session (.pca or a video).
+# labels.csv (in CORPUS by default) has the columns `frame` (file name or frame id) and `positive`
+# (space separated template names shown in the frame), frames not listed are skipped.
+# areas.csv has the columns `template,x1,x2,y1,y2` at 1920x1080.
+# テンプレートごとに閾値を調整するツール
+import argparse
+import csv
+import json
+import logging
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+from pokecon.logger import setup_logging
+from pokecon.template import REFERENCE_SIZE, TEMPLATE_PATH, TemplateCache
+
+
+# (gray, use area, scale) tried for every template, the area configs only for templates in areas.csv
+CONFIGS = [(gray, area, scale) for area in (True, False) for gray in (True, False) for scale in (1.0, 0.5)]
+# frames scored by a worker per task
+CHUNK = 16
+
+
+def read_labels(path):
+    labels = {}
+    with open(path, encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f):
+            labels[row['frame']] = set(row['positive'].split())
+    return labels
+
+
+def read_areas(path):
+    areas = {}
+    if path is not None and Path(path).exists():
+        with open(path, encoding='utf-8', newline='') as f:
+            for row in csv.DictReader(f):
+                areas[row['template']] = [int(row[k]) for k in ('x1', 'x2', 'y1', 'y2')]
+    return areas
+
+
+# state of a worker process
+_worker = {}
+
+
+def _init_worker(corpus, template_dir):
+    _worker['corpus'] = Path(corpus)
+    _worker['templates'] = TemplateCache(template_dir)
+    _worker['archive'] = None
+    _worker['video'] = None
+    if _worker['corpus'].suffix == '.pca':
+        from pokecon.archive import ArchiveReader
+        _worker['archive'] = ArchiveReader(corpus)
+    elif not _worker['corpus'].is_dir():
+        _worker['video'] = cv2.VideoCapture(str(corpus))
+
+
+# every worker decodes its own frames, so that frames are not pickled from the parent
+def _load(key):
+    if _worker['archive'] is not None:
+        return _worker['archive'].get(int(key))
+    video = _worker['video']
+    if video is not None:
+        # frames are mostly submitted in order, seeking is only needed after a gap
+        if int(video.get(cv2.CAP_PROP_POS_FRAMES)) != int(key):
+            video.set(cv2.CAP_PROP_POS_FRAMES, int(key))
+        ref, frame = video.read()
+        return frame if ref else None
+    return cv2.imread(str(_worker['corpus'].joinpath(key)), cv2.IMREAD_COLOR)
+
+
+# scores and times of every template and config on one frame
+def _score_frame(key, templates, areas):
+    cache = _worker['templates']
+    frame = _load(key)
+    results = []
+    if frame is None:
+        return key, results
+    live = frame.shape[1] / REFERENCE_SIZE[0]
+    gray_frame = None
+    for name in templates:
+        area = areas.get(name)
+        for config in CONFIGS:
+            gray, use_area, scale = config
+            # without an area the config is the same as the full one
+            if use_area and not area:
+                continue
+            started = perf_counter()
+            if gray:
+                # counted once per config, as every check converts the frame
+                gray_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+            src = gray_frame if gray else frame
+            if use_area:
+                x1, x2, y1, y2 = [int(round(v * live)) for v in area]
+                src = src[y1:y2, x1:x2]
+            if scale != 1.0:
+                src = cv2.resize(src, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+            templ = cache.get(name, gray, scale=round(live * scale, 4))
+            if templ.shape[0] > src.shape[0] or templ.shape[1] > src.shape[1]:
+                continue
+            res = cv2.matchTemplate(src, templ, cv2.TM_CCOEFF_NORMED)
+            _, max_val, _, _ = cv2.minMaxLoc(res)
+            results.append((name, config, max_val, perf_counter() - started))
+    return key, results
+
+
+def _score_frames(keys, templates, areas):
+    return [_score_frame(key, templates, areas) for key in keys]
+
+
+# keys of the labelled frames, file names or frame ids of an archive or indices of a video
+def frames_of(labels):
+    return sorted(labels, key=lambda key: (0, int(key), '') if key.isdigit() else (1, 0, key))
+
+
+def summarize(values):
+    if not values:
+        return None
+    values = np.array(values)
+    return {q: float(np.percentile(values, p)) for q, p in (('min', 0), ('p5', 5), ('p50', 50), ('p95', 95),
+                                                            ('max', 100))}
+
+
+def evaluate(scores, times, min_margin):
+    report = {}
+    for name in sorted({name for name, _ in scores}):
+        configs = {}
+        for config in CONFIGS:
+            positive, negative = scores[name, config]['positive'], scores[name, config]['negative']
+            if not positive or not negative:
+                continue
+            margin = min(positive) - max(negative)
+            configs[config] = {
+                'positive': summarize(positive),
+                'negative': summarize(negative),
+                'margin': margin,
+                'threshold': (min(positive) + max(negative)) / 2,
+                'seconds': float(np.mean(times[name, config])),
+            }
+        if not configs:
+            report[name] = None
+            continue
+        best = max(configs, key=lambda c: configs[c]['margin'])
+        keeping = [c for c in configs if configs[c]['margin'] >= max(min_margin, 0.0)]
+        fastest = min(keeping, key=lambda c: configs[c]['seconds']) if keeping else None
+        report[name] = {
+            'threshold': configs[best]['threshold'],
+            'margin': configs[best]['margin'],
+            'best': _config_dict(best),
+            'fastest': _config_dict(fastest) if fastest else None,
+            'fastest_threshold': configs[fastest]['threshold'] if fastest else None,
+            'configs': {_config_name(c): v for c, v in configs.items()},
+        }
+    return report
+
+
+def _config_dict(config):
+    return {'gray': config[0], 'area': config[1], 'scale': config[2]}
+
+
+def _config_name(config):
+    gray, area, scale = config
+    return f'{"gray" if gray else "color"}/{"area" if area else "full"}/x{scale}'
+
+
+def calibrate(corpus, labels, areas=None, template_dir=TEMPLATE_PATH, workers=None, min_margin=0.05):
+    template_dir = Path(template_dir)
+    areas = areas or {}
+    names = sorted(str(p.relative_to(template_dir)) for p in template_dir.rglob('*.png'))
+    scores = defaultdict(lambda: {'positive': [], 'negative': []})
+    times = defaultdict(list)
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(str(corpus), str(template_dir))) as pool:
+        keys = frames_of(labels)
+        # consecutive frames go to the same worker, so that a video is read on without seeking
+        futures = [pool.submit(_score_frames, keys[i:i + CHUNK], names, areas) for i in range(0, len(keys), CHUNK)]
+        for key, results in (item for future in futures for item in future.result()):
+            for name, config, score, seconds in results:
+                label = 'positive' if Path(name).stem in labels[key] or name in labels[key] else 'negative'
+                scores[name, config][label].append(score)
+                times[name, config].append(seconds)
+    return evaluate(scores, times, min_margin)
+
+
+def print_report(report):
+    for name, result in report.items():
+        if result is None:
+            print(f'{name}: needs positive and negative frames')
+            continue
+        print(f'{name}: threshold {result["threshold"]:.3f}, margin {result["margin"]:.3f} '
+              f'({_config_name(tuple(result["best"].values()))})')
+        for config, values in result['configs'].items():
+            p, n = values['positive'], values['negative']
+            print(f'    {config:18} positive {p["min"]:.3f}..{p["p50"]:.3f}..{p["max"]:.3f}  '
+                  f'negative {n["min"]:.3f}..{n["p50"]:.3f}..{n["max"]:.3f}  '
+                  f'margin {values["margin"]:+.3f}  {values["seconds"] * 1000:.2f} ms')
+        if result['fastest'] is not None:
+            print(f'    fastest: {_config_name(tuple(result["fastest"].values()))}, '
+                  f'threshold {result["fastest_threshold"]:.3f}')
+        else:
+            print('    fastest: no configuration keeps the margin')
+
+
+def main():
+    setup_logging(logging.INFO)
+    parser = argparse.ArgumentParser(description='Calibrate template thresholds on labelled frames')
+    parser.add_argument('corpus', help='directory of screenshots or a recorded session')
+    parser.add_argument('--labels', help='labels.csv (default: CORPUS/labels.csv or next to the session)')
+    parser.add_argument('--areas', help='areas.csv of template areas at 1920x1080')
+    parser.add_argument('--templates', default=str(TEMPLATE_PATH), help='template directory')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--min-margin', type=float, default=0.05, help='margin the fastest config must keep')
+    parser.add_argument('--json', help='write the report to this file')
+    args = parser.parse_args()
+    corpus = Path(args.corpus)
+    labels_path = args.labels or (corpus.joinpath('labels.csv') if corpus.is_dir()
+                                  else corpus.with_name('labels.csv'))
+    report = calibrate(corpus, read_labels(labels_path), read_areas(args.areas), args.templates, args.workers,
+                       args.min_margin)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,93 @@
 import datetime
+import threading
+from time import perf_counter
 
 import cv2
+import numpy as np
 
+from pokecon import metrics
 from pokecon.logger import get_logger
 
 
 logger = get_logger(__name__)
 
 
+# A preallocated frame, reused once nobody refers to it
+class FrameBuffer:
+    def __init__(self, pool, array):
+        self.pool = pool
+        self.array = array
+        self.refs = 0
+        # when it was handed out last, the least recently used free buffer is reused first
+        self.used = 0
+        self.frame_id = -1
+        self.timestamp = None
+
+    def acquire(self):
+        with self.pool.lock:
+            self.refs += 1
+        return self
+
+    def release(self):
+        with self.pool.lock:
+            self.refs -= 1
+
+
+# Buffers the device reads into, so that steady-state capture allocates no frames.
+# A buffer is only reused when its reference count is 0, the least recently used first,
+# so a frame stays intact for `size - 1` more reads even without a reference.
+# If every buffer is referred the pool grows by one
+# フレームのバッファを使い回すためのプール
+class FramePool:
+    def __init__(self, size=6):
+        self.size = size
+        self.lock = threading.Lock()
+        self.shape = None
+        self.buffers = []
+        self.count = 0
+
+    def reset(self, shape):
+        with self.lock:
+            self.shape = shape
+            self.buffers = [FrameBuffer(self, np.empty(shape, np.uint8)) for _ in range(self.size)]
+
+    def adopt(self, array):
+        with self.lock:
+            self.shape = array.shape
+            buffer = FrameBuffer(self, array)
+            self.buffers = [buffer] + [FrameBuffer(self, np.empty(array.shape, np.uint8))
+                                       for _ in range(self.size - 1)]
+        return buffer
+
+    # a free buffer with one reference for the caller
+    def get(self):
+        with self.lock:
+            self.count += 1
+            free = [buffer for buffer in self.buffers if buffer.refs == 0]
+            if free:
+                buffer = min(free, key=lambda b: b.used)
+                buffer.refs, buffer.used = 1, self.count
+                return buffer
+            buffer = FrameBuffer(self, np.empty(self.shape, np.uint8))
+            buffer.refs, buffer.used = 1, self.count
+            self.buffers.append(buffer)
+        logger.debug(f'frame pool grew to {len(self.buffers)} buffers')
+        return buffer
+
+
+# screenshot_<time>.png in path_dir, shared by the captures
+def save_screenshot(path_dir, frame):
+    if frame is None:
+        logger.warning('no frame to save yet')
+        return None
+    filename = f'screenshot_{datetime.datetime.now():%Y%m%d%H%M%S}.png'
+    path = path_dir.joinpath(filename)
+    path.parent.mkdir(exist_ok=True)
+    cv2.imwrite(str(path), frame)
+    logger.info(f'successfully saved image: {filename}')
+    return path
+
+
 class Capture:
     def __init__(self, camera_id, w, h, fps, path_dir):
         super().__init__()
@@ -17,21 +97,96 @@ class Capture:
         self.fps = fps
         self.ref = None
         self.frame = None
+        # frame_id counts frames read from the device, timestamp is perf_counter() when it was read
+        self.frame_id = -1
+        self.timestamp = None
         self.path_dir = path_dir
+        # the GUI and scripts read from different threads
+        self.lock = threading.RLock()
+        # callables of (frame_id, timestamp, frame) called for every frame read
+        self.sinks = []
+        self.recorder = None
+        self.pool = FramePool()
+        self.pool.reset((h, w, 3))
+        # buffer of self.frame, referred by the capture until the next frame
+        self.buffer = None
 
+    # the frame is a copy owned by the caller, read_buffer avoids the copy
     def read(self):
-        self.ref, self.frame = self.src.read()
-        return self.ref, self.frame
+        with self.lock:
+            if not self._read():
+                return self.ref, None
+            return self.ref, self.frame.copy()
+
+    # Read the next frame into a pooled buffer, which is overwritten a few reads later (FramePool.size).
+    # Sinks are called with the pooled frame, so a sink copies what it keeps
+    def _read(self):
+        with self.lock:
+            buffer = self.pool.get()
+            ref, frame = self.src.read(image=buffer.array)
+            if not ref:
+                buffer.release()
+                self.ref = ref
+                return False
+            if frame is not buffer.array:
+                # the device delivers another size than requested, follow it
+                buffer.release()
+                buffer = self.pool.adopt(frame)
+                buffer.refs = 1
+                logger.info(f'capture size: {frame.shape[1]}x{frame.shape[0]}')
+            self.frame_id += 1
+            self.timestamp = perf_counter()
+            buffer.frame_id, buffer.timestamp = self.frame_id, self.timestamp
+            if self.buffer is not None:
+                self.buffer.release()
+            self.buffer = buffer
+            self.ref, self.frame = ref, frame
+            metrics.capture_frames.inc()
+            metrics.capture_fps.tick(self.timestamp)
+            for sink in self.sinks:
+                sink(self.frame_id, self.timestamp, self.frame)
+            return True
+
+    # read a frame without a copy, its buffer is kept until FrameBuffer.release
+    def read_buffer(self):
+        with self.lock:
+            ref = self._read()
+            return ref, self.buffer.acquire() if ref else None
+
+    def add_sink(self, sink):
+        self.sinks = self.sinks + [sink]
+
+    def remove_sink(self, sink):
+        self.sinks = [s for s in self.sinks if s != sink]
+
+    # Record frames to an archive (see ArchiveWriter for the options)
+    # 録画を開始します
+    def start_recording(self, path, **kwargs):
+        from pokecon.archive import ArchiveWriter
+        if self.recorder is not None:
+            return
+        self.recorder = ArchiveWriter(path, **kwargs)
+        self.add_sink(self.recorder.write)
+        logger.info(f'started recording: {self.recorder.path.name}')
+
+    def stop_recording(self):
+        if self.recorder is None:
+            return
+        self.remove_sink(self.recorder.write)
+        self.recorder.close()
+        self.recorder = None
+
+    def is_recording(self):
+        return self.recorder is not None
 
     def is_opened(self):
         return self.src.isOpened()
 
     def release(self):
+        self.stop_recording()
         return self.src.release()
 
     def screenshot(self):
-        filename = f'screenshot_{datetime.datetime.now():%Y%m%d%H%M%S}.png'
-        path = self.path_dir.joinpath(filename)
-        path.parent.mkdir(exist_ok=True)
-        cv2.imwrite(str(path), self.frame)
-        logger.info(f'successfully saved image: {filename}')
+        # the pooled frame is not reused while the lock is held
+        with self.lock:
+            save_screenshot(self.path_dir, self.frame)
@@ -0,0 +1,97 @@
+import asyncio
+import heapq
+import threading
+from time import perf_counter, sleep
+
+
+# sleep() can overshoot by a scheduler tick, the last part of sleep_until is spun
+SPIN = 0.002
+
+
+# Wall clock used by commands for waiting
+class Clock:
+    def time(self):
+        return perf_counter()
+
+    def sleep(self, seconds):
+        sleep(seconds)
+
+    # wake at `deadline` (a time() value) within microseconds, for frame-precise inputs
+    def sleep_until(self, deadline):
+        remaining = deadline - perf_counter()
+        if remaining > SPIN:
+            sleep(remaining - SPIN)
+        while perf_counter() < deadline:
+            pass
+
+    # sleep of AsyncPythonCommand, other tasks run meanwhile
+    async def sleep_async(self, seconds):
+        await asyncio.sleep(seconds)
+
+
+# Clock that only advances when someone sleeps on it, so that waits finish immediately.
+# With `speed` the waits still sleep for seconds/speed in real time
+# sleepが呼ばれたときだけ進む仮想時計です
+class VirtualClock(Clock):
+    def __init__(self, start=0.0, speed=None):
+        self.now = start
+        self.speed = speed
+        self.timers = []
+        # (deadline, count) of the tasks in sleep_async
+        self.waiting = []
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if seconds <= 0:
+            return
+        if self.speed:
+            sleep(seconds / self.speed)
+        self.advance(seconds)
+
+    def sleep_until(self, deadline):
+        self.sleep(deadline - self.now)
+
+    # Tasks waiting at once wake in the order of their deadlines: each yields to the loop
+    # until its deadline is the earliest, then moves the clock to it
+    async def sleep_async(self, seconds):
+        with self.lock:
+            self.count += 1
+            entry = (self.now + max(seconds, 0), self.count)
+            heapq.heappush(self.waiting, entry)
+        try:
+            await asyncio.sleep(0)
+            while self.waiting[0] != entry:
+                await asyncio.sleep(0)
+        finally:
+            with self.lock:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+        delay = entry[0] - self.now
+        if delay <= 0:
+            return
+        if self.speed:
+            await asyncio.sleep(delay / self.speed)
+        self.advance(delay)
+
+    def advance(self, seconds):
+        with self.lock:
+            target = self.now + seconds
+            due = []
+            while self.timers and self.timers[0][0] <= target:
+                at, _, callback = heapq.heappop(self.timers)
+                due.append((at, callback))
+        # timers run at their own time on the caller's thread
+        for at, callback in due:
+            self.now = max(self.now, at)
+            callback()
+        self.now = max(self.now, target)
+
+    # call `callback` when the clock reaches `at`
+    def call_at(self, at, callback):
+        with self.lock:
+            self.count += 1
+            heapq.heappush(self.timers, (at, self.count, callback))
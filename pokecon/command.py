@@ -1,18 +1,25 @@
+import statistics
 import threading
 from abc import ABCMeta
-from pathlib import Path
-from time import sleep
+from collections import deque
+from time import perf_counter
 from typing import Callable
 
 import cv2
 
+from pokecon import metrics
 from pokecon.capture import Capture
+from pokecon.clock import Clock
+from pokecon.framecache import FrameCache
+from pokecon.framesync import FrameClock, FrameTiming, timings_text
+from pokecon.latency import ChangeProbe, Latency, load_latency
 from pokecon.logger import get_logger
+from pokecon.overlay import overlays
 from pokecon.pad import Input
 from pokecon.ports import SerialSender
-
-
-TEMPLATE_PATH = Path(__file__).parent.joinpath('../templates/')
+from pokecon.sound import SoundDetector
+from pokecon.stats import ScriptStats
+from pokecon.template import match_template, templates
 
 
 logger = get_logger(__name__)
@@ -29,7 +36,7 @@ class Command:
     def __init__(self):
         self.isRunning = False
 
-    def start(self, ser, post_process=None):
+    def start(self, ser, post_process=None, sound=None):
         pass
 
     def end(self):
@@ -46,6 +53,12 @@ class PythonCommand(Command):
         self.thread = None
         self.alive = True
         self.post_process = None
+        self.sound = None
+        # replaced by a VirtualClock to run faster than real time
+        self.clock = Clock()
+        self.stats = None
+        # measured input-to-screen latency, e.g. self.wait(self.latency.reaction(0.5))
+        self.latency = Latency()
 
     def do(self):
         pass
@@ -59,18 +72,24 @@ class PythonCommand(Command):
         except StopThread:
             logger.info('-- finished successfully. --')
         except Exception as e:
+            metrics.script_exceptions.inc(1, self.NAME, type(e).__name__)
             logger.error(e, exc_info=True)
             self.finish()
 
     def start(self,
               ser: SerialSender,
-              post_process: Callable = None):
+              post_process: Callable = None,
+              sound: SoundDetector = None):
         self.input = Input(ser)
         self.alive = True
         self.post_process = post_process
+        self.sound = sound
+        self.stats = ScriptStats(self.NAME, self.clock)
+        self.latency = load_latency()
         if self.thread is None:
             self.thread = threading.Thread(target=self.do_safe)
             self.thread.start()
+        return self.thread
 
     def end(self):
         self.send_stop_request()
@@ -99,6 +118,32 @@ class PythonCommand(Command):
             self.press(buttons, duration, 0 if i == repeat - 1 else interval)
         self.wait(wait)
 
+    # tilt a stick to any angle (degrees, 0: right, 90: up) and magnitude (0 to 1), then back to the center
+    # スティックを任意の角度と倒し具合で倒します
+    def tilt(self, stick, degree, magnitude=1.0, duration=0.1, wait=0.1):
+        self.input.tilt(stick, degree, magnitude)
+        self.wait(duration)
+        self.input.center(stick)
+        self.wait(wait)
+
+    # Play a trajectory (see pokecon.trajectory) at its rate, the reports are made before playing
+    # スティックの軌道を一定間隔で送ります
+    def play(self, trajectory, release=True):
+        rows = self.input.stick_rows(trajectory.stick, trajectory.values)
+        interval = 1 / trajectory.rate
+        started = self.clock.time()
+        for i, row in enumerate(rows):
+            # deadlines are absolute, so that a late report does not delay the rest
+            delay = started + i * interval - self.clock.time()
+            if delay > 0:
+                self.clock.sleep(delay)
+            self.input.write_row(row, trajectory.stick, *trajectory.values[i])
+            self.check_if_alive()
+        self.clock.sleep(max(started + len(rows) * interval - self.clock.time(), 0))
+        if release:
+            self.input.center(trajectory.stick)
+        self.check_if_alive()
+
     # add hold buttons
     def hold(self, buttons, wait=0.1):
         self.input.hold(buttons)
@@ -109,83 +154,291 @@ class PythonCommand(Command):
         self.input.hold_end(buttons)
         self.check_if_alive()
 
+    # count an event (e.g. an egg or a reset), its rate per hour is shown while running
+    # イベントの回数を数えます(実行中は1時間あたりの回数が表示されます)
+    def count(self, name, n=1):
+        self.stats.count(name, n)
+
+    # call at the start of every loop iteration to measure its cycle time
+    # ループの先頭で呼ぶと1周の時間を計測します
+    def cycle(self):
+        self.stats.cycle()
+
+    def stats_text(self):
+        return self.stats.text() if self.stats is not None else ''
+
     # do nothing at wait time(s)
     def wait(self, wait=0.1):
-        sleep(wait)
+        self.clock.sleep(wait)
         self.check_if_alive()
 
+    # wait until the sound (a file name in sounds/ without .wav) is heard, returns False on timeout
+    # 指定した音(sounds/のファイル名)が鳴るまで待機します
+    def wait_for_sound(self, name, timeout=None):
+        if self.sound is None:
+            raise RuntimeError('Sound detector is not available')
+        since = self.sound.hits[name]
+        deadline = None if timeout is None else perf_counter() + timeout
+        while True:
+            remaining = 0.1 if deadline is None else min(deadline - perf_counter(), 0.1)
+            if remaining <= 0:
+                return False
+            if self.sound.wait_for(name, remaining, since):
+                return True
+            self.check_if_alive()
+
     def check_if_alive(self):
+        metrics.script_iterations.inc(1, self.NAME)
         if self.alive:
             return True
         else:
-            if self.input is not None:
-                self.input.end()
-                self.input = None
+            self.cleanup()
+            # raise exception for exit working thread
+            raise StopThread()
 
-            if self.thread is not None:
-                self.thread = None
+    def cleanup(self):
+        if self.input is not None:
+            self.input.end()
+            self.input = None
 
-            if self.post_process is not None:
-                self.post_process()
-                self.post_process = None
+        # summary of the run is written once, on the way out
+        if self.stats is not None and self.thread is not None and self.stats.used() and self.stats.saved is None:
+            self.stats.save()
 
-            # raise exception for exit working thread
-            raise StopThread()
+        if self.thread is not None:
+            self.thread = None
+
+        if self.post_process is not None:
+            self.post_process()
+            self.post_process = None
 
 
 class ImageProcPythonCommand(PythonCommand):
+    # templates scaled before do() starts, paths relative to templates/
+    TEMPLATES = []
+    # a frame counts as unchanged, and the results of the checks on the previous frame are reused, while
+    # no cell mean (64x36 cells, 30x30 pixels at 1920x1080) differs by more than this (0 to 255),
+    # so a change of about 1% of a cell is noticed, raise it for noisy captures, None to disable
+    FRAME_TOLERANCE = 2.0
+
     def __init__(self, cap: Capture):
         super().__init__()
         self.cap = cap
+        self.frames = FrameCache(self.FRAME_TOLERANCE)
+        # perf_counter() when the memo frame was read
+        self.frame_time = None
+        # timeline of the captured frames for run_at_frame
+        self.frame_clock = FrameClock(cap.fps if cap is not None else 60)
+        self.frame_timings = []
+        # seconds taken by the recent serial writes of run_at_frame
+        self.write_times = deque(maxlen=32)
+
+    def do_safe(self):
+        self.prepare()
+        super().do_safe()
+
+    def prepare(self):
+        if self.TEMPLATES and self.cap is not None:
+            templates.update_size(self.cap.w, self.cap.h)
+            templates.preload(self.TEMPLATES)
+        # every captured frame is observed when the capture has sinks, otherwise the frames read by the script
+        if hasattr(self.cap, 'add_sink'):
+            self.cap.add_sink(self.frame_clock.publish)
+
+    # Derived images of the current frame, shared by all checks until the script waits
+    # or the frame is older than a frame interval, then the next frame is read
+    # 現在のフレームとその派生画像(待機するか1フレーム経過するまで共有されます)
+    def frame_memo(self):
+        memo = self.frames.memo
+        if memo is None or self.frame_time is None or perf_counter() - self.frame_time >= 1 / self.cap.fps:
+            memo = self.frames.read(self.cap)
+            self.frame_time = perf_counter()
+            self.frame_clock.observe(memo.timestamp)
+        return memo
+
+    def cleanup(self):
+        if hasattr(self.cap, 'remove_sink'):
+            self.cap.remove_sink(self.frame_clock.publish)
+        if self.frame_timings:
+            logger.info(timings_text(self.frame_timings))
+            self.frame_timings = []
+        self.frame_clock.clear()
+        self.frames.clear()
+        super().cleanup()
+
+    # the screen changes while waiting, so checks after a wait look at a new frame
+    def wait(self, wait=0.1):
+        self.frame_time = None
+        super().wait(wait)
 
     # Judge if current screenshot contains a template using template matching
     # It's recommended that you use gray_scale option
     # unless the template color wouldn't be cared for performance
     # 現在のスクリーンショットと指定した画像のテンプレートマッチングを行います
     # 色の違いを考慮しないのであればパフォーマンスの点からuse_grayをTrueにしてグレースケール画像を使うことを推奨します
+    # Templates, area and tmpl_area are given at 1920x1080 and scaled to the capture size,
+    # band > 0 also tries `band` scales 5% apart on each side of it
+    # テンプレートとareaは1920x1080基準で指定し、キャプチャーの解像度に合わせて拡大縮小されます
     def is_contain_template(self,
                             template_path,
                             threshold=0.7,
                             use_gray=True,
                             show_value=False,
                             area=None,
-                            tmpl_area=None):
+                            tmpl_area=None,
+                            band=0):
 
         if tmpl_area is None:
             tmpl_area = []
         if area is None:
             area = []
 
-        # Read a current image
-        _, src = self.cap.read()
-        src = cv2.cvtColor(src, cv2.COLOR_BGR2GRAY) if use_gray else src
-        src = src[area[2]:area[3], area[0]:area[1]] if area else src
-
-        # Read a template image
-        path = TEMPLATE_PATH / template_path
-        templ = cv2.imread(str(path),
-                           cv2.IMREAD_GRAYSCALE if use_gray else cv2.IMREAD_COLOR)
-        templ = templ[tmpl_area[2]:tmpl_area[3], tmpl_area[0]:tmpl_area[1]] if tmpl_area else templ
-        w, h = templ.shape[1], templ.shape[0]
-
-        method = cv2.TM_CCOEFF_NORMED
-        res = cv2.matchTemplate(src, templ, method)
-        _, max_val, _, max_loc = cv2.minMaxLoc(res)
+        return self.check_template(self.frame_memo(), template_path, threshold, use_gray, show_value, area,
+                                   tmpl_area, band)
+
+    # is_contain_template on a given frame
+    def check_template(self, memo, template_path, threshold=0.7, use_gray=True, show_value=False, area=None,
+                       tmpl_area=None, band=0):
+        started = perf_counter()
+        templates.update_size(memo.frame.shape[1], memo.frame.shape[0])
+        area = templates.scale_area(area)
+
+        def match():
+            # Scaled template images are cached
+            value = match_template(memo.crop(area, use_gray), templates, template_path, use_gray, tmpl_area, band)
+            metrics.match_total.inc(1, str(template_path))
+            metrics.match_seconds.observe(perf_counter() - started, str(template_path))
+            return value
+
+        # reused while the screen does not change
+        key = ('template', str(template_path), use_gray, tuple(area) if area else None,
+               tuple(tmpl_area) if tmpl_area else None, band, templates.scale)
+        result = memo.result(key, match)
+        if result is None:
+            logger.warning(f'{template_path} is larger than the area')
+            return False
+        max_val, max_loc, (w, h) = result
 
         if show_value:
             logger.debug(f'{template_path} ZNCC value: {max_val}')
 
         if max_val > threshold:
-            if use_gray:
-                src = cv2.cvtColor(src, cv2.COLOR_GRAY2BGR)
-
-            top_left = max_loc
-            bottom_right = (top_left[0] + w, top_left[1] + h)
-            cv2.rectangle(src, top_left, bottom_right, (255, 0, 255), 2)
+            # the preview draws it, so nothing is drawn on the frame here
+            x, y = (max_loc[0] + area[0], max_loc[1] + area[2]) if area else max_loc
+            overlays.publish((x, y, w, h), str(template_path), max_val, memo.frame_id)
             return True
         else:
             return False
 
+    # Run `action` (serial writes) so that its input shows on the frame `frames` after `base`, a FrameMemo
+    # (by default the frame checked last, e.g. where is_contain_template found the template).
+    # The write is issued ahead by the calibrated latency (see scripts/latency.py) and the time
+    # the recent writes took. With `area` ([x1, x2, y1, y2] at 1920x1080) the frame where the area
+    # changes is measured as the achieved offset, the result is logged and returned as a FrameTiming
+    # 指定したフレームからframesフレーム後に入力が画面に反映されるように実行します
+    def run_at_frame(self, action, frames, base=None, area=None):
+        base, target, deadline = self.frame_deadline(frames, base)
+        probe = self.frame_probe(area)
+        try:
+            # waited in slices to answer stop requests, the last slice is precise
+            while deadline - self.clock.time() > 0.1:
+                self.clock.sleep(0.05)
+                self.check_if_alive()
+            if probe is not None:
+                self.arm_probe(probe)
+            self.warn_late(base, frames, deadline)
+            self.clock.sleep_until(deadline)
+            started = self.clock.time()
+            action()
+            written = self.clock.time()
+            hit = None
+            if probe is not None:
+                hit = self.wait_probe(probe, max(target - written, 0) + self.latency.reaction())
+        finally:
+            self.remove_probe(probe)
+        timing = self.frame_timing(base, frames, started, written, probe, hit)
+        self.check_if_alive()
+        return timing
+
+    # press buttons so that they show on the frame `frames` after `base`, e.g.
+    #   if self.is_contain_template('start.png'):
+    #       self.press_at_frame(Button.A, 37)
+    # with `area` the buttons are released once the change is seen, and not before `duration`
+    def press_at_frame(self, buttons, frames, base=None, duration=0.1, wait=0.1, area=None):
+        timing = self.run_at_frame(lambda: self.input.press(buttons), frames, base, area)
+        self.wait(max(timing.written + duration - self.clock.time(), 0))
+        self.input.press_end(buttons)
+        self.wait(wait)
+        return timing
+
+    # (base memo, time of the target frame, time to write) of an input `frames` after `base`
+    def frame_deadline(self, frames, base):
+        base = self.frames.memo if base is None else base
+        if base is None or base.timestamp is None:
+            raise RuntimeError('no frame has been checked yet')
+        if not self.latency.calibrated and not self.frame_timings:
+            logger.warning('latency is not calibrated, inputs are written at the frame time')
+        ahead = self.latency.p50 + (statistics.median(self.write_times) if self.write_times else 0.0)
+        target = self.frame_clock.time_of(base.timestamp, frames)
+        # the input shows on a frame if it arrives after the previous one is captured, so the middle is aimed at
+        return base, target, target - self.frame_clock.period() / 2 - ahead
+
+    def warn_late(self, base, frames, deadline):
+        late = self.clock.time() - deadline
+        if late > 0:
+            logger.warning(f'frame {base.frame_id} + {frames} is {late * 1000:.1f} ms late')
+
+    def frame_probe(self, area):
+        if area is None:
+            return None
+        probe = ChangeProbe(area)
+        self.add_probe(probe)
+        return probe
+
+    def frame_timing(self, base, frames, started, written, probe, hit):
+        self.write_times.append(written - started)
+        expected = self.frame_clock.frames_between(base.timestamp, written + self.latency.p50) + 0.5
+        achieved = None
+        if hit is not None:
+            achieved = round(self.frame_clock.frames_between(base.timestamp, hit[1]))
+        elif probe is not None:
+            logger.warning(f'frame {base.frame_id} + {frames}: the input was not seen in the area')
+        timing = FrameTiming(base.frame_id, frames, expected, written, achieved)
+        self.frame_timings.append(timing)
+        logger.info(f'frame-locked input: {timing.text()}')
+        return timing
+
+    # A ChangeProbe (see pokecon.latency) sees every captured frame as a sink of the capture,
+    # captures without sinks (a script process, the emulator, a replay) are polled by wait_probe
+    # 画面の変化を監視します
+    def add_probe(self, probe):
+        if hasattr(self.cap, 'add_sink'):
+            self.cap.add_sink(probe.publish)
+
+    def remove_probe(self, probe):
+        if probe is not None and hasattr(self.cap, 'remove_sink'):
+            self.cap.remove_sink(probe.publish)
+
+    def feed_probe(self, probe):
+        memo = self.frames.read(self.cap)
+        if memo.frame is not None:
+            probe.publish(memo.frame_id, memo.timestamp, memo.frame)
+
+    # start watching for a change, call right before the input
+    def arm_probe(self, probe):
+        if not hasattr(self.cap, 'add_sink'):
+            self.feed_probe(probe)
+        return probe.arm(self.clock.time())
+
+    # (frame_id, timestamp) of the first changed frame or None on timeout
+    def wait_probe(self, probe, timeout):
+        if hasattr(self.cap, 'add_sink'):
+            return probe.wait(timeout)
+        deadline = self.clock.time() + timeout
+        while probe.changed_frame() is None and self.clock.time() < deadline:
+            self.feed_probe(probe)
+        return probe.wait(0)
+
     # Get inter frame difference barbarized image
     # フレーム間差分により2値化された画像を取得
     @staticmethod
@@ -1,4 +1,4 @@
-from configparser import ConfigParser, NoOptionError
+from configparser import ConfigParser, NoOptionError, NoSectionError
 from dataclasses import dataclass
 from pathlib import Path
 
@@ -8,6 +8,8 @@ class AppConfig:
     width: int = 1280
     height: int = 720
     fps: int = 60
+    # run scripts in a child process, frames are shared through the frame bus
+    script_process: bool = False
 
 
 @dataclass
@@ -18,14 +20,87 @@ class SerialConfig:
 @dataclass
 class CaptureConfig:
     camera_id: int = 0
+    camera_name: str = ''
+    # name of the shared memory to publish frames to other processes, empty to disable
+    frame_bus: str = ''
     width: int = 1920
     height: int = 1080
     fps: int = 60
 
 
+@dataclass
+class RecordConfig:
+    # jpeg or delta (lossless)
+    codec: str = 'jpeg'
+    gray: bool = False
+    scale: float = 1.0
+    quality: int = 90
+    keyframe_interval: int = 60
+
+
 @dataclass
 class AudioConfig:
     volume: bool = True
+    rate: int = 44100
+    channels: int = 2
+    # 0: chosen by PortAudio
+    frames_per_buffer: int = 0
+    # -1: default device
+    input_device: int = -1
+    output_device: int = -1
+    # callback: Python callback in this process, process: blocking loop in a child process
+    mode: str = 'callback'
+
+
+# keys of pynput are written as 'Key.shift_l', an empty value leaves the input unbound
+@dataclass
+class KeyboardConfig:
+    a: str = 'l'
+    b: str = 'k'
+    x: str = 'j'
+    y: str = 'i'
+    l: str = 'q'
+    r: str = 'e'
+    zl: str = 'u'
+    zr: str = 'o'
+    l_click: str = 'Key.shift_l'
+    r_click: str = 'Key.shift_r'
+    minus: str = 'Key.ctrl_l'
+    plus: str = 'Key.ctrl_r'
+    home: str = 'h'
+    capture: str = 'f'
+    up: str = 'w'
+    right: str = 'd'
+    down: str = 's'
+    left: str = 'a'
+    hat_top: str = 'Key.up'
+    hat_right: str = 'Key.right'
+    hat_btm: str = 'Key.down'
+    hat_left: str = 'Key.left'
+
+
+# Prometheus text format on http://127.0.0.1:<port>/metrics
+@dataclass
+class MetricsConfig:
+    enabled: bool = False
+    port: int = 9108
+
+
+# MJPEG preview on http://127.0.0.1:<port>/ (stream.mjpg?fps=N, snapshot.jpg)
+@dataclass
+class PreviewConfig:
+    enabled: bool = False
+    port: int = 9109
+    width: int = 640
+    quality: int = 70
+    fps: int = 30
+
+
+# local control API on http://127.0.0.1:<port>/ (see pokecon/control.py)
+@dataclass
+class ControlConfig:
+    enabled: bool = False
+    port: int = 9110
 
 
 class Config:
@@ -34,13 +109,18 @@ class Config:
         self.app: AppConfig = AppConfig()
         self.serial: SerialConfig = SerialConfig()
         self.capture: CaptureConfig = CaptureConfig()
+        self.record: RecordConfig = RecordConfig()
         self.audio: AudioConfig = AudioConfig()
+        self.keyboard: KeyboardConfig = KeyboardConfig()
+        self.metrics: MetricsConfig = MetricsConfig()
+        self.preview: PreviewConfig = PreviewConfig()
+        self.control: ControlConfig = ControlConfig()
 
     def read(self):
         if self.path.exists():
             config = ConfigParser()
             config.read(self.path, encoding='utf-8')
-            for section in ['app', 'serial', 'capture', 'audio']:
+            for section in ['app', 'serial', 'capture', 'record', 'audio', 'keyboard', 'metrics', 'preview', 'control']:
                 r = eval(f'self.{section}')
                 for k in vars(r):
                     attr = type(getattr(r, k))
@@ -53,13 +133,13 @@ class Config:
                             setattr(r, k, config.getboolean(section, k))
                         elif attr is str:
                             setattr(r, k, config.get(section, k))
-                    except NoOptionError:
+                    except (NoSectionError, NoOptionError):
                         print('WARNING : {} NO OPTION'.format(k))
 
     def write(self):
         self.path.parent.mkdir(exist_ok=True)
         config = ConfigParser()
-        for section in ['app', 'serial', 'capture', 'audio']:
+        for section in ['app', 'serial', 'capture', 'record', 'audio', 'keyboard', 'metrics', 'preview', 'control']:
             r = eval(f'self.{section}')
             config[section] = {}
             for k in vars(r):
@@ -0,0 +1,153 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter, sleep
+
+from pokecon.logger import get_logger
+from pokecon.pad import Button, Direction, Hat, Stick
+
+
+logger = get_logger(__name__)
+
+
+# "A", "Hat.TOP" or "Direction.UP"
+def parse_input(name):
+    kind, _, value = name.rpartition('.')
+    types = {'': Button, 'Button': Button, 'Hat': Hat, 'Direction': Direction}
+    if kind not in types or value not in types[kind].__members__:
+        raise ValueError(f'unknown input: {name}')
+    return types[kind][value]
+
+
+def parse_inputs(names):
+    return [parse_input(name) for name in ([names] if isinstance(names, str) else names)]
+
+
+# Applies timed input events through the serial port, an event is one of
+#   {"at": 0.0, "press": ["A", "Hat.TOP"]}
+#   {"at": 0.1, "release": ["A"]}
+#   {"at": 0.2, "tilt": {"stick": "LEFT", "degree": 90, "magnitude": 1.0}}
+#   {"at": 0.3, "center": "LEFT"}
+# `at` is seconds from the start of the batch, returns how late the writes were
+def play_events(input_, events):
+    events = sorted(events, key=lambda e: e.get('at', 0.0))
+    # parsed before the first write, so that a bad event does not leave buttons pressed
+    actions = []
+    for event in events:
+        if 'press' in event:
+            actions.append((event.get('at', 0.0), input_.press, (parse_inputs(event['press']),)))
+        elif 'release' in event:
+            actions.append((event.get('at', 0.0), input_.press_end, (parse_inputs(event['release']),)))
+        elif 'tilt' in event:
+            tilt = event['tilt']
+            args = (Stick[tilt.get('stick', 'LEFT')], float(tilt['degree']), float(tilt.get('magnitude', 1.0)))
+            actions.append((event.get('at', 0.0), input_.tilt, args))
+        elif 'center' in event:
+            actions.append((event.get('at', 0.0), input_.center, (Stick[event['center']],)))
+        else:
+            raise ValueError(f'unknown event: {event}')
+    started = perf_counter()
+    late = []
+    for at, action, args in actions:
+        delay = started + at - perf_counter()
+        if delay > 0:
+            sleep(delay)
+        late.append(perf_counter() - started - at)
+        action(*args)
+    return late
+
+
+# Local HTTP API to control the app from other processes
+#   GET  /status              state of the app
+#   GET  /scripts             names of the scripts
+#   POST /scripts/start       {"name": "A連打"}
+#   POST /scripts/stop
+#   POST /input               {"press": ["A"], "duration": 0.1}
+#   POST /input/batch         {"events": [...]} (see play_events)
+# Inputs are refused while a script is running
+# 外部のプロセスからスクリプトや入力を操作するためのAPI
+class ControlServer:
+    def __init__(self, app, port=9110, host='127.0.0.1'):
+        # provides scripts(), status(), start_script(name), stop_script(), input() and is_playing()
+        self.app = app
+        # one batch at a time, so that events of different requests and scripts do not interleave
+        self.input_lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        host, port = self.server.server_address[:2]
+        logger.info(f'control: http://{host}:{port}/')
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self, path):
+        if path == '/status':
+            return 200, self.app.status()
+        if path == '/scripts':
+            return 200, {'scripts': self.app.scripts()}
+        return 404, {'error': 'not found'}
+
+    def post(self, path, body):
+        if path == '/scripts/start':
+            if body.get('name') not in self.app.scripts():
+                return 404, {'error': f'unknown script: {body.get("name")}'}
+            # the app counts as playing from the request on, so that no batch starts before the script
+            if not self.input_lock.acquire(blocking=False):
+                return 409, {'error': 'inputs are being sent'}
+            try:
+                if self.app.is_playing():
+                    return 409, {'error': 'a script is running'}
+                self.app.start_script(body['name'])
+            finally:
+                self.input_lock.release()
+            return 202, {'started': body['name']}
+        if path == '/scripts/stop':
+            self.app.stop_script()
+            return 202, {}
+        if path in ('/input', '/input/batch'):
+            if path == '/input':
+                duration = float(body.get('duration', 0.1))
+                events = [{'at': 0.0, 'press': body['press']}, {'at': duration, 'release': body['press']}]
+            else:
+                events = body['events']
+            with self.input_lock:
+                if self.app.is_playing():
+                    return 409, {'error': 'a script is running'}
+                # the pad state is shared with the keyboard
+                late = play_events(self.app.input(), events)
+            return 200, {'events': len(late), 'late_max': max(late, default=0.0)}
+        return 404, {'error': 'not found'}
+
+    def handler(self):
+        control = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.respond(*control.get(self.path.split('?')[0]))
+
+            def do_POST(self):
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    body = json.loads(self.rfile.read(length) or b'{}')
+                    result = control.post(self.path.split('?')[0], body)
+                except (ValueError, KeyError, TypeError) as e:
+                    result = 400, {'error': str(e)}
+                self.respond(*result)
+
+            def respond(self, status, body):
+                data = json.dumps(body, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format_, *args):
+                pass
+
+        return Handler
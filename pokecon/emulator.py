@@ -0,0 +1,217 @@
+import logging
+from collections import deque
+from dataclasses import dataclass, replace
+from pathlib import Path
+from time import perf_counter
+
+import cv2
+import numpy as np
+
+from pokecon.clock import VirtualClock
+from pokecon.command import ImageProcPythonCommand
+from pokecon.logger import get_logger, setup_logging
+from pokecon.pad import Button, Hat, CENTER
+
+
+logger = get_logger(__name__)
+
+
+@dataclass
+class ControllerState:
+    btn: Button = Button(0)
+    hat: Hat = Hat.CENTER
+    lx: int = CENTER
+    ly: int = CENTER
+    rx: int = CENTER
+    ry: int = CENTER
+
+    def pressed(self, button):
+        return bool(self.btn & button)
+
+
+# Parse a row written by SerialFormat.str into the controller state
+# SerialFormatの文字列をコントローラーの状態に変換します
+def parse_report(row, state=None):
+    if state is None or row == 'end':
+        state = ControllerState()
+    if row == 'end':
+        return state
+    values = row.split()
+    flags = int(values[0], 16)
+    state = replace(state, btn=Button(flags >> 2), hat=Hat(int(values[1])))
+    i = 2
+    # sticks are only sent when they changed
+    if flags & 0x2:
+        state.lx, state.ly = int(values[i], 16), int(values[i + 1], 16)
+        i += 2
+    if flags & 0x1:
+        state.rx, state.ry = int(values[i], 16), int(values[i + 1], 16)
+    return state
+
+
+# SerialSender compatible sink which keeps the controller state instead of writing to a port
+class EmulatedSerial:
+    def __init__(self, clock, history=100000):
+        self.clock = clock
+        self.state = ControllerState()
+        self.history = deque(maxlen=history)
+        self.listeners = []
+        self.reports = 0
+
+    def open(self, port):
+        return True
+
+    def close(self):
+        pass
+
+    def is_open(self):
+        return True
+
+    def write(self, row):
+        previous, self.state = self.state, parse_report(row, self.state)
+        self.reports += 1
+        self.history.append((self.clock.time(), self.state))
+        for listener in self.listeners:
+            listener(previous, self.state)
+
+
+# Screens of the emulated console, which change on inputs or after some time
+# 入力や時間経過で切り替わる画面の状態遷移
+class ScreenMachine:
+    def __init__(self, clock, initial=None, size=(1920, 1080)):
+        self.clock = clock
+        self.size = size
+        self.screens = {}
+        self.inputs = {}
+        self.timeouts = {}
+        self.state = initial
+        self.entered = clock.time()
+        self.pending = None
+
+    # `image` is an array or a path, it is pasted on a black screen when `position` is given
+    def add_screen(self, name, image, position=None):
+        if isinstance(image, (str, Path)):
+            image = cv2.imread(str(image), cv2.IMREAD_COLOR)
+        if position is not None:
+            screen = np.zeros((self.size[1], self.size[0], 3), dtype=np.uint8)
+            x, y = position
+            screen[y:y + image.shape[0], x:x + image.shape[1]] = image
+            image = screen
+        self.screens[name] = image
+        if self.state is None:
+            self.state = name
+        return self
+
+    # move to `next_state` `delay` seconds after `trigger` (a Button or a Hat) is pressed
+    def on_input(self, state, trigger, next_state, delay=0.0):
+        self.inputs.setdefault(state, []).append((trigger, next_state, delay))
+        return self
+
+    # move to `next_state` after staying `seconds` in `state`
+    def after(self, state, seconds, next_state):
+        self.timeouts[state] = (seconds, next_state)
+        return self
+
+    def on_report(self, previous, current):
+        for trigger, next_state, delay in self.inputs.get(self.state, []):
+            if type(trigger) is Hat:
+                pressed = current.hat == trigger and previous.hat != trigger
+            else:
+                pressed = current.pressed(trigger) and not previous.pressed(trigger)
+            if pressed and self.pending is None:
+                self.pending = (next_state, self.clock.time() + delay)
+
+    def enter(self, state, at):
+        logger.debug(f'screen: {self.state} -> {state}')
+        self.state = state
+        self.entered = at
+        self.pending = None
+
+    def update(self):
+        now = self.clock.time()
+        while True:
+            if self.pending is not None and self.pending[1] <= now:
+                self.enter(*self.pending)
+            elif self.state in self.timeouts and self.entered + self.timeouts[self.state][0] <= now:
+                seconds, next_state = self.timeouts[self.state]
+                self.enter(next_state, self.entered + seconds)
+            else:
+                break
+
+    def frame(self):
+        self.update()
+        return self.screens[self.state]
+
+
+# Capture compatible source which shows the current screen of the machine
+class EmulatedCapture:
+    def __init__(self, machine: ScreenMachine, path_dir=Path('screenshot')):
+        self.machine = machine
+        self.w, self.h = machine.size
+        self.fps = 60
+        self.ref = None
+        self.frame = None
+        self.frame_id = -1
+        self.timestamp = None
+        self.path_dir = path_dir
+
+    # like a device, a read waits for the next frame, so polling loops also move the virtual clock
+    def read(self):
+        self.machine.clock.sleep(1 / self.fps)
+        self.ref, self.frame = True, self.machine.frame().copy()
+        self.frame_id += 1
+        self.timestamp = self.machine.clock.time()
+        return self.ref, self.frame
+
+    def is_opened(self):
+        return True
+
+    def release(self):
+        pass
+
+    def screenshot(self):
+        logger.info(f'screenshot is skipped on the emulator: {self.machine.state}')
+
+
+# Runs a script against the emulated serial and capture on a virtual clock
+# 仮想時計の上でスクリプトを実機なしで実行します
+#
+#   emulator = Emulator()
+#   emulator.machine.add_screen('title', 'templates/logo.png', (0, 0))
+#   emulator.run(MashA, timeout=3600)
+class Emulator:
+    def __init__(self, speed=None, size=(1920, 1080)):
+        # headless runs have no app.py to set up the console (does nothing if it is already set up)
+        setup_logging(logging.INFO)
+        self.clock = VirtualClock(speed=speed)
+        self.ser = EmulatedSerial(self.clock)
+        self.machine = ScreenMachine(self.clock, size=size)
+        self.ser.listeners.append(self.machine.on_report)
+        self.cap = EmulatedCapture(self.machine)
+
+    def create(self, cls):
+        if issubclass(cls, ImageProcPythonCommand):
+            script = cls(self.cap)
+        else:
+            script = cls()
+        script.clock = self.clock
+        return script
+
+    # run until the script finishes or `timeout` seconds pass on the virtual clock
+    def run(self, cls, timeout=None):
+        script = self.create(cls)
+        started, virtual_started = perf_counter(), self.clock.time()
+        if timeout is not None:
+            self.clock.call_at(virtual_started + timeout, script.end)
+        script.start(self.ser).join()
+        elapsed = perf_counter() - started
+        virtual = self.clock.time() - virtual_started
+        result = {
+            'virtual': virtual,
+            'elapsed': elapsed,
+            'speed': virtual / elapsed if elapsed > 0 else float('inf'),
+            'reports': self.ser.reports,
+        }
+        logger.info(f'{cls.NAME}: {virtual:.1f} s in {elapsed:.2f} s '
+                    f'(x{result["speed"]:.0f}, {result["reports"]} reports)')
+        return result
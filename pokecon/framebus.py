@@ -0,0 +1,183 @@
+import os
+from dataclasses import dataclass
+from multiprocessing import shared_memory
+from time import perf_counter, sleep
+
+import cv2
+import numpy as np
+
+from pokecon.logger import get_logger
+
+
+MAGIC = 0x50434642
+HEADER_DTYPE = np.dtype([
+    ('magic', '<u4'),
+    ('slots', '<u4'),
+    ('height', '<u4'),
+    ('width', '<u4'),
+    ('channels', '<u4'),
+    ('pad', '<u4'),
+    # sequence number of the last published frame, 0 while nothing is published
+    ('latest', '<i8'),
+])
+SLOT_DTYPE = np.dtype([
+    # sequence number of the frame in the slot, -1 while it is being written
+    ('seq', '<i8'),
+    ('frame_id', '<i8'),
+    ('timestamp', '<f8'),
+])
+
+
+logger = get_logger(__name__)
+
+
+# names of the buses published by this process
+_published = set()
+
+
+# frames start at a 64 bytes boundary after the header and the slots
+def _frames_offset(slots):
+    return -(-(HEADER_DTYPE.itemsize + SLOT_DTYPE.itemsize * slots) // 64) * 64
+
+
+def _layout(buf, slots=None, shape=None):
+    header = np.ndarray((1,), dtype=HEADER_DTYPE, buffer=buf)[0]
+    if slots is None:
+        slots = int(header['slots'])
+        shape = (int(header['height']), int(header['width']), int(header['channels']))
+    meta = np.ndarray((slots,), dtype=SLOT_DTYPE, buffer=buf, offset=HEADER_DTYPE.itemsize)
+    frames = np.ndarray((slots,) + tuple(shape), dtype=np.uint8, buffer=buf, offset=_frames_offset(slots))
+    return header, meta, frames
+
+
+@dataclass
+class BusFrame:
+    seq: int
+    frame_id: int
+    timestamp: float
+    # view into the shared memory, valid while `FrameBusReader.is_valid` is True
+    image: np.ndarray
+
+
+# Publishes captured frames into a ring of preallocated buffers in shared memory.
+# The publisher never waits for readers, a slow reader just misses frames
+# キャプチャーしたフレームを共有メモリに書き込みます
+class FrameBusPublisher:
+    def __init__(self, name, slots=4):
+        self.name = name
+        self.slots = slots
+        self.shm = None
+        self.sequence = 0
+
+    def create(self, shape):
+        shape = shape if len(shape) == 3 else shape + (1,)
+        size = _frames_offset(self.slots) + self.slots * int(np.prod(shape))
+        self.shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+        _published.add(self.name)
+        self.header, self.meta, self.frames = _layout(self.shm.buf, self.slots, shape)
+        self.meta['seq'] = 0
+        self.header['slots'] = self.slots
+        self.header['height'], self.header['width'], self.header['channels'] = shape
+        self.header['latest'] = 0
+        self.header['magic'] = MAGIC
+        logger.info(f'frame bus {self.name}: {shape[1]}x{shape[0]}, {self.slots} slots')
+
+    # same signature as a capture sink
+    def publish(self, frame_id, timestamp, frame):
+        if self.shm is None:
+            self.create(frame.shape)
+        seq = self.sequence + 1
+        slot = seq % self.slots
+        dst = self.frames[slot]
+        self.meta[slot]['seq'] = -1
+        if frame.shape[:2] == dst.shape[:2]:
+            np.copyto(dst, frame.reshape(dst.shape))
+        else:
+            cv2.resize(frame, (dst.shape[1], dst.shape[0]), dst=dst.reshape(dst.shape[:2] + frame.shape[2:]))
+        self.meta[slot]['frame_id'] = frame_id
+        self.meta[slot]['timestamp'] = timestamp
+        self.meta[slot]['seq'] = seq
+        self.header['latest'] = seq
+        self.sequence = seq
+
+    def close(self):
+        if self.shm is not None:
+            del self.header, self.meta, self.frames
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+            _published.discard(self.name)
+
+
+# Attaches to a frame bus from any local process and reads frames without copying
+# 共有メモリのフレームをコピーせずに読み込みます
+class FrameBusReader:
+    def __init__(self, name):
+        self.name = name
+        self.shm = shared_memory.SharedMemory(name=name)
+        # NOTE: only the publisher owns the memory, do not let this process unlink it at exit
+        if os.name == 'posix' and name not in _published:
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.header, self.meta, self.frames = _layout(self.shm.buf)
+        if int(self.header['magic']) != MAGIC:
+            raise ValueError(f'not a frame bus: {name}')
+        self.slots = int(self.header['slots'])
+        self.last = 0
+
+    @property
+    def shape(self):
+        h, w, c = self.frames.shape[1:]
+        return (h, w) if c == 1 else (h, w, c)
+
+    # the frame of the sequence number, or None if its slot is already reused
+    def frame(self, seq):
+        slot = seq % self.slots
+        meta = self.meta[slot]
+        frame = BusFrame(seq, int(meta['frame_id']), float(meta['timestamp']), self.frames[slot].reshape(self.shape))
+        if int(meta['seq']) != seq:
+            return None
+        self.last = seq
+        return frame
+
+    # the latest frame, or None if nothing is published yet
+    def latest(self):
+        while True:
+            seq = int(self.header['latest'])
+            if seq <= 0:
+                return None
+            frame = self.frame(seq)
+            if frame is not None:
+                return frame
+
+    # wait for a frame newer than the last one read, returns None on timeout
+    def wait_next(self, timeout=None, interval=0.001):
+        deadline = None if timeout is None else perf_counter() + timeout
+        while True:
+            seq = int(self.header['latest'])
+            if seq > self.last:
+                frame = self.frame(seq)
+                if frame is not None:
+                    return frame
+            if deadline is not None and perf_counter() >= deadline:
+                return None
+            sleep(interval)
+
+    # False once the publisher has overwritten the slot of the frame
+    def is_valid(self, frame):
+        return int(self.meta[frame.seq % self.slots]['seq']) == frame.seq
+
+    # copy the latest frame, retrying if it is overwritten while copying
+    def copy_latest(self):
+        while True:
+            frame = self.latest()
+            if frame is None:
+                return None
+            image = frame.image.copy()
+            if self.is_valid(frame):
+                frame.image = image
+                return frame
+
+    def close(self):
+        del self.header, self.meta, self.frames
+        self.shm.close()
@@ -0,0 +1,130 @@
+import cv2
+import numpy as np
+
+
+# cells of the change signature along each axis, 30x30 pixels at 1080p
+SIGNATURE_SIZE = (64, 36)
+
+
+# Mean of every cell, so that a change anywhere in a cell moves it (unlike sampled pixels)
+def signature(frame):
+    return cv2.resize(frame, SIGNATURE_SIZE, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+
+# Images derived from one frame, computed on first use and shared by every check on the frame
+# 1フレームから作る画像(グレースケール、縮小、HSV、切り抜き)を必要になった時に一度だけ計算します
+class FrameMemo:
+    def __init__(self, frame_id, frame, buffer=None, timestamp=None):
+        self.frame_id = frame_id
+        self.frame = frame
+        # perf_counter() when the capture read the frame
+        self.timestamp = timestamp
+        # FrameBuffer of a pooled capture, released with the memo
+        self.buffer = buffer
+        self.products = {}
+        # results of checks, carried over to the next memo while the screen does not change
+        self.results = {}
+        self.signature = None
+        self.unchanged = False
+
+    # another reference to the buffer, for a check which may outlive the memo (released by the caller).
+    # Without a buffer, or once the memo is released, None: the pool keeps the frame for a few more reads
+    def hold(self):
+        buffer = self.buffer
+        if buffer is not None:
+            buffer.acquire()
+        return buffer
+
+    def release(self):
+        if self.buffer is not None:
+            self.buffer.release()
+            self.buffer = None
+
+    # any product, e.g. the result of a probe or OCR on the frame
+    def get(self, key, function):
+        value = self.products.get(key)
+        if value is None:
+            value = self.products[key] = function()
+        return value
+
+    # a result of a check (template, probe, OCR) on the frame, reused on unchanged frames.
+    # The key must hold every parameter of the check
+    def result(self, key, function):
+        if key in self.results:
+            return self.results[key]
+        value = self.results[key] = function()
+        return value
+
+    def image(self, gray=False):
+        return self.gray() if gray else self.frame
+
+    def gray(self):
+        return self.get('gray', lambda: cv2.cvtColor(self.frame, cv2.COLOR_BGR2GRAY))
+
+    def hsv(self):
+        return self.get('hsv', lambda: cv2.cvtColor(self.frame, cv2.COLOR_BGR2HSV))
+
+    # 1/2 and 1/4 of the size, the quarter is made from the half
+    def half(self, gray=False):
+        return self.get(('half', gray), lambda: cv2.resize(self.image(gray), None, fx=0.5, fy=0.5,
+                                                           interpolation=cv2.INTER_AREA))
+
+    def quarter(self, gray=False):
+        return self.get(('quarter', gray), lambda: cv2.resize(self.half(gray), None, fx=0.5, fy=0.5,
+                                                              interpolation=cv2.INTER_AREA))
+
+    # [x1, x2, y1, y2] of the full size image, a view without copying
+    def crop(self, area, gray=False):
+        if not area:
+            return self.image(gray)
+        return self.get(('crop', tuple(area), gray),
+                        lambda: self.image(gray)[area[2]:area[3], area[0]:area[1]])
+
+
+# Keeps the memo of the latest frame only, it is released when a newer frame arrives.
+# A new frame is unchanged if no cell mean of its signature differs by more than `tolerance` (0 to 255)
+# from the frame the results were computed on, and the results are carried over. None disables it
+class FrameCache:
+    def __init__(self, tolerance=1.0):
+        self.memo = None
+        self.tolerance = tolerance
+
+    def update(self, frame_id, frame, buffer=None, timestamp=None):
+        if self.memo is None or self.memo.frame_id != frame_id or frame_id < 0:
+            previous = self.memo
+            self.memo = FrameMemo(frame_id, frame, buffer, timestamp)
+            if previous is not None:
+                previous.release()
+            self.carry_over(previous, self.memo)
+        elif buffer is not None:
+            buffer.release()
+        return self.memo
+
+    def carry_over(self, previous, memo):
+        if self.tolerance is None or memo.frame is None:
+            return
+        current = signature(memo.frame)
+        if previous is not None and previous.signature is not None and \
+                current.shape == previous.signature.shape and \
+                np.abs(current - previous.signature).max() <= self.tolerance:
+            # compared with the frame of the results, so that a slow fade is still noticed
+            memo.signature = previous.signature
+            memo.results = previous.results
+            memo.unchanged = True
+        else:
+            memo.signature = current
+
+    # read the next frame of the capture, a pooled buffer is kept while it is the memo
+    def read(self, cap):
+        if hasattr(cap, 'read_buffer'):
+            ref, buffer = cap.read_buffer()
+            if not ref:
+                return self.update(-1, None)
+            return self.update(buffer.frame_id, buffer.array, buffer, buffer.timestamp)
+        _, frame = cap.read()
+        return self.update(cap.frame_id, frame, timestamp=cap.timestamp)
+
+    def clear(self):
+        if self.memo is not None:
+            self.memo.release()
+        self.memo = None
@@ -0,0 +1,109 @@
+import math
+import threading
+from collections import deque
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+
+# Frame grid of the capture device, the phase is fitted to the timestamps of the recent frames.
+# Frame ids count reads, which skip frames when nobody reads in between, so only timestamps are used
+# キャプチャーのフレームの時刻(周期と位相)をタイムスタンプから推定します
+class FrameClock:
+    def __init__(self, fps=60, window=2.0):
+        self.nominal = 1 / fps
+        # seconds of samples, short enough that a slightly wrong period does not smear the phase
+        self.window = window
+        self.lock = threading.Lock()
+        self.samples = deque()
+        self.fit = None
+
+    def observe(self, timestamp):
+        if timestamp is None:
+            return
+        with self.lock:
+            if self.samples and timestamp <= self.samples[-1]:
+                return
+            self.samples.append(timestamp)
+            while self.samples[0] < timestamp - self.window:
+                self.samples.popleft()
+            self.fit = None
+
+    # capture sink
+    def publish(self, frame_id, timestamp, frame):
+        self.observe(timestamp)
+
+    # (period, phase) of the grid, the phase is None before any frame is observed
+    def grid(self):
+        with self.lock:
+            if self.fit is None:
+                if not self.samples:
+                    return self.nominal, None
+                times = np.array(self.samples, dtype=np.float64)
+                period = self.nominal
+                # consecutive device frames, reads after a wait are further apart
+                steps = np.diff(times)
+                steps = steps[(steps > 0.5 * self.nominal) & (steps < 1.5 * self.nominal)]
+                if len(steps) >= 8:
+                    period = float(np.median(steps))
+                # circular mean of the timestamps modulo the period
+                angles = 2 * np.pi * np.mod(times, period) / period
+                angle = math.atan2(np.sin(angles).mean(), np.cos(angles).mean())
+                self.fit = (period, (angle / (2 * np.pi) % 1) * period)
+            return self.fit
+
+    def period(self):
+        return self.grid()[0]
+
+    # the frame time closest to `timestamp`
+    def snap(self, timestamp):
+        period, phase = self.grid()
+        if phase is None:
+            return timestamp
+        return phase + round((timestamp - phase) / period) * period
+
+    # time of the frame `frames` after the frame captured at `timestamp`
+    def time_of(self, timestamp, frames):
+        return self.snap(timestamp) + frames * self.period()
+
+    # fractional frames from the frame captured at `base` to `timestamp`
+    def frames_between(self, base, timestamp):
+        return (timestamp - self.snap(base)) / self.period()
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+            self.fit = None
+
+
+# Result of an input scheduled relative to a frame, offsets are in frames from the base frame
+@dataclass
+class FrameTiming:
+    base: int
+    target: int
+    # offset predicted from the write time and the calibrated latency, within 0.5 of the target is on time
+    expected: float
+    written: float
+    # offset of the first frame where the input was seen, None unless measured
+    achieved: Optional[int] = None
+
+    @property
+    def error(self):
+        return None if self.achieved is None else self.achieved - self.target
+
+    def text(self):
+        measured = 'not measured' if self.achieved is None else f'achieved {self.achieved} ({self.error:+d})'
+        return f'frame {self.base} + {self.target}: {measured}, expected {self.expected:.2f}'
+
+
+# one line for the end of a run, the measured errors if any were measured
+def timings_text(timings):
+    expected = [abs(t.expected - t.target) for t in timings]
+    text = (f'frame-locked inputs: {len(timings)}, expected error mean {sum(expected) / len(expected):.2f} / '
+            f'max {max(expected):.2f} frames')
+    errors = [t.error for t in timings if t.error is not None]
+    if errors:
+        text += (f', measured {len(errors)}: {errors.count(0)} on target, '
+                 f'error max {max(errors, key=abs):+d} frames')
+    return text
@@ -0,0 +1,250 @@
+import importlib
+import logging
+import multiprocessing
+import threading
+from time import perf_counter, process_time, sleep
+
+from pokecon.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+
+# Connection.send is not thread-safe, the script, the stats and the log handler share it
+class _Sender:
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def send(self, *msg):
+        with self.lock:
+            self.conn.send(msg)
+
+
+# SerialSender compatible writer which forwards rows to the parent's serial port
+class PipeSerial:
+    def __init__(self, sender):
+        self.sender = sender
+
+    def open(self, port):
+        return True
+
+    def close(self):
+        pass
+
+    def is_open(self):
+        return True
+
+    def write(self, row):
+        self.sender.send('write', row)
+
+
+# Capture compatible reader of the parent's frame bus
+class FrameBusCapture:
+    def __init__(self, name, timeout=1.0):
+        from pokecon.framebus import FrameBusReader
+        self.reader = FrameBusReader(name)
+        self.timeout = timeout
+        self.h, self.w = self.reader.shape[:2]
+        self.fps = 60
+        self.ref = None
+        self.frame = None
+        self.frame_id = -1
+        self.timestamp = None
+
+    # like a device, wait for the next frame; it is copied since the slot is reused soon
+    def read(self):
+        while True:
+            frame = self.reader.wait_next(self.timeout)
+            if frame is None:
+                self.ref = False
+                return self.ref, None
+            image = frame.image.copy()
+            if self.reader.is_valid(frame):
+                break
+        self.ref, self.frame = True, image
+        self.frame_id, self.timestamp = frame.frame_id, frame.timestamp
+        return self.ref, self.frame
+
+    def is_opened(self):
+        return True
+
+    def release(self):
+        self.reader.close()
+
+    def screenshot(self):
+        logger.warning('screenshot is not available in a script process')
+
+
+class _PipeHandler(logging.Handler):
+    def __init__(self, sender):
+        super().__init__()
+        self.sender = sender
+        self.setFormatter(logging.Formatter('%(message)s'))
+
+    def emit(self, record):
+        self.sender.send('log', record.levelno, record.name, self.format(record))
+
+
+# psutil is a requirement, the fallback only covers environments installed without it
+def _usage():
+    rss = None
+    try:
+        import psutil
+        rss = psutil.Process().memory_info().rss
+    except ImportError:
+        try:
+            import resource
+            # NOTE: peak resident size in KB on Linux
+            rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        except ImportError:
+            pass
+    return process_time(), rss
+
+
+def _report_usage(sender, script, interval):
+    while True:
+        sender.send('stats', *_usage())
+        sender.send('stats_text', script.stats_text())
+        sleep(interval)
+
+
+# requests of the parent, the stats summary is saved before the process is killed
+def _receive(conn, sender, script):
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            break
+        if msg[0] == 'save':
+            if script.stats is not None and script.stats.used() and script.stats.saved is None:
+                script.stats.save()
+            sender.send('saved')
+
+
+# entry point of the script process
+def _run_script(module, name, bus, conn, interval):
+    from pokecon.command import ImageProcPythonCommand
+    sender = _Sender(conn)
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG)
+    root.addHandler(_PipeHandler(sender))
+    cls = getattr(importlib.import_module(module), name)
+    if issubclass(cls, ImageProcPythonCommand):
+        script = cls(FrameBusCapture(bus) if bus else None)
+    else:
+        script = cls()
+    threading.Thread(target=_report_usage, args=(sender, script, interval), daemon=True).start()
+    threading.Thread(target=_receive, args=(conn, sender, script), daemon=True).start()
+    script.start(PipeSerial(sender)).join()
+    sender.send('stats', *_usage())
+    sender.send('done')
+
+
+# Runs a PythonCommand in a child process, so that its Python code does not compete with the GUI for the GIL.
+# Inputs are forwarded to the serial port of this process and frames are read from the frame bus.
+# Stopping kills the process right after it has saved the stats summary
+# スクリプトを子プロセスで実行します(停止するとプロセスを即座に終了します)
+class ProcessCommand:
+    def __init__(self, cls, bus=None, interval=1.0):
+        self.cls = cls
+        self.NAME = cls.NAME
+        self.bus = bus
+        self.interval = interval
+        self.process = None
+        self.thread = None
+        self.sender = None
+        self.saved = threading.Event()
+        self.ser = None
+        self.post_process = None
+        self.killed = False
+        self.started = None
+        self.cpu = 0.0
+        self.rss = None
+        self.rss_max = 0
+        self.text = ''
+
+    def start(self, ser, post_process=None, sound=None):
+        if sound is not None:
+            logger.debug('sounds are not detected in a script process')
+        self.ser = ser
+        self.post_process = post_process
+        self.killed = False
+        self.saved.clear()
+        ctx = multiprocessing.get_context('spawn')
+        conn, child_conn = ctx.Pipe()
+        self.sender = _Sender(conn)
+        self.process = ctx.Process(target=_run_script,
+                                   args=(self.cls.__module__, self.cls.__qualname__, self.bus, child_conn,
+                                         self.interval),
+                                   daemon=True)
+        self.started = perf_counter()
+        self.process.start()
+        child_conn.close()
+        self.thread = threading.Thread(target=self.forward, args=(conn,), daemon=True)
+        self.thread.start()
+        return self.thread
+
+    def forward(self, conn):
+        while True:
+            try:
+                msg = conn.recv()
+            except (EOFError, OSError):
+                break
+            kind = msg[0]
+            if kind == 'write':
+                self.ser.write(msg[1])
+            elif kind == 'log':
+                logging.getLogger(msg[2]).log(msg[1], msg[3])
+            elif kind == 'stats':
+                self.cpu, self.rss = msg[1], msg[2]
+                self.rss_max = max(self.rss_max, self.rss or 0)
+            elif kind == 'stats_text':
+                self.text = msg[1]
+            elif kind == 'saved':
+                self.saved.set()
+            elif kind == 'done':
+                break
+        conn.close()
+        self.process.join()
+        self.finish()
+
+    def finish(self):
+        # a killed script may leave buttons pressed
+        if self.killed:
+            self.ser.write('end')
+            logger.info('-- killed the script process. --')
+        self.report()
+        if self.post_process is not None:
+            self.post_process()
+            self.post_process = None
+
+    # waits up to `timeout` for the child to save the stats, then kills it
+    def end(self, timeout=1.0):
+        if self.process is not None and self.process.is_alive():
+            try:
+                self.sender.send('save')
+                if not self.saved.wait(timeout):
+                    logger.warning('the script process did not save its stats in time')
+            except OSError:
+                pass
+            self.killed = True
+            self.process.kill()
+
+    # counters and cycle times of the script, the child writes the summary file itself
+    def stats_text(self):
+        return self.text
+
+    # Log CPU time and memory usage of the script process
+    def report(self):
+        elapsed = perf_counter() - self.started
+        result = {
+            'elapsed': elapsed,
+            'cpu': self.cpu,
+            'cpu_ratio': self.cpu / elapsed if elapsed > 0 else 0.0,
+            'rss_max': self.rss_max,
+        }
+        memory = f'{self.rss_max / 2 ** 20:.1f} MB' if self.rss_max else 'unknown'
+        logger.info(f'{self.NAME}: cpu {self.cpu:.1f} s ({result["cpu_ratio"] * 100:.0f}%) '
+                    f'in {elapsed:.1f} s, memory {memory}')
+        return result
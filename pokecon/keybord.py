@@ -1,5 +1,10 @@
+import threading
+from collections import deque
+from time import perf_counter
+
 from pynput.keyboard import Key, Listener
 
+from pokecon.config import KeyboardConfig
 from pokecon.logger import get_logger
 from pokecon.pad import Input, Button, Hat, Direction
 
@@ -29,103 +34,173 @@ class Keyboard:
         logger.info(f'{key} released')
 
 
+# Switch inputs for each option of KeyboardConfig
+COMMANDS = {
+    'a': Button.A,
+    'b': Button.B,
+    'x': Button.X,
+    'y': Button.Y,
+    'l': Button.L,
+    'r': Button.R,
+    'zl': Button.ZL,
+    'zr': Button.ZR,
+    'l_click': Button.L_CLICK,
+    'r_click': Button.R_CLICK,
+    'minus': Button.MINUS,
+    'plus': Button.PLUS,
+    'home': Button.HOME,
+    'capture': Button.CAPTURE,
+    'up': Direction.UP,
+    'right': Direction.RIGHT,
+    'down': Direction.DOWN,
+    'left': Direction.LEFT,
+    'hat_top': Hat.TOP,
+    'hat_right': Hat.RIGHT,
+    'hat_btm': Hat.BTM,
+    'hat_left': Hat.LEFT,
+}
+
+# NOTE: Direction is not hashable, so diagonals are looked up by names
+DIAGONALS = {
+    frozenset(('UP', 'RIGHT')): Direction.UP_RIGHT,
+    frozenset(('UP', 'LEFT')): Direction.UP_LEFT,
+    frozenset(('DOWN', 'RIGHT')): Direction.DOWN_RIGHT,
+    frozenset(('DOWN', 'LEFT')): Direction.DOWN_LEFT,
+}
+
+
+# 'Key.shift_l' is a special key of pynput, the others are characters
+def parse_key(value):
+    if value.startswith('Key.'):
+        return getattr(Key, value[4:])
+    return value
+
+
+def load_key_map(config: KeyboardConfig):
+    key_map = {}
+    for k, command in COMMANDS.items():
+        value = getattr(config, k)
+        if value:
+            key_map[parse_key(value)] = command
+    return key_map
+
+
 # This regards a keyboard inputs as Switch controller
 class KeyboardController(Keyboard):
-    def __init__(self, input_: Input):
+    def __init__(self, input_: Input, key_map=None):
         super().__init__()
         self.input = input_
-        self.holding = []
-        self.holding_direction = []
-
-        self.key_map = {
-            'l': Button.A,
-            'k': Button.B,
-            'j': Button.X,
-            'i': Button.Y,
-            'q': Button.L,
-            'e': Button.R,
-            'u': Button.ZL,
-            'o': Button.ZR,
-            Key.shift_l: Button.L_CLICK,
-            Key.shift_r: Button.R_CLICK,
-            Key.ctrl_l: Button.MINUS,
-            Key.ctrl_r: Button.PLUS,
-            'h': Button.HOME,
-            'f': Button.CAPTURE,
-            'w': Direction.UP,
-            'd': Direction.RIGHT,
-            's': Direction.DOWN,
-            'a': Direction.LEFT,
-            Key.up: Hat.TOP,
-            Key.right: Hat.RIGHT,
-            Key.down: Hat.BTM,
-            Key.left: Hat.LEFT,
-        }
-        # self.inverse_key_map = {v: k for k, v in self.key_map.items()}
-        self.direction_key = [k for k, v in self.key_map.items() if type(v) is Direction]
-
-    def inverse_lookup(self, x):
-        for k, v in self.key_map.items():
-            if x == v:
-                return k
+        # the listener keeps running while the window is inactive, inputs are ignored unless enabled
+        self.enabled = False
+        self.holding = set()
+        # keys are kept in pressed order since the last 2 directions are combined
+        self.holding_direction = {}
+        # the listener thread handles the keys, the GUI thread disables the controller
+        self.lock = threading.Lock()
+        # seconds from a key callback (press or release) to the end of its serial write,
+        # pynput gives no time of the OS event, so the hook delivery before the callback is not included
+        self.latency = deque(maxlen=1000)
+
+        self.key_map = key_map if key_map is not None else load_key_map(KeyboardConfig())
+        self.compile()
+
+    # build lookup tables from the key map so that each event is handled with dict lookups
+    def compile(self):
+        self.buttons = {k: v for k, v in self.key_map.items() if type(v) is not Direction}
+        self.directions = {k: v for k, v in self.key_map.items() if type(v) is Direction}
+        self.diagonals = {}
+        for k1, d1 in self.directions.items():
+            for k2, d2 in self.directions.items():
+                diagonal = DIAGONALS.get(frozenset((d1.name, d2.name)))
+                if diagonal is not None:
+                    self.diagonals[frozenset((k1, k2))] = diagonal
+
+    def enable(self):
+        self.enabled = True
+
+    # release everything held, otherwise the controller keeps the state after losing focus
+    def disable(self):
+        with self.lock:
+            self.enabled = False
+            for key_ in self.holding:
+                self.input.press_end(self.buttons[key_])
+            for direction in self.holding_direction.values():
+                self.input.press_end(direction)
+            self.holding.clear()
+            self.holding_direction.clear()
 
     def on_press(self, key):
         # for debug (show row key data)
         # super().on_press(key)
+        started = perf_counter()
 
         if key is None:
             logger.warning('unknown key has input')
 
-        try:
-            key_ = key.char
-        # for special keys
-        except AttributeError:
-            key_ = key
+        # special keys do not have char
+        key_ = getattr(key, 'char', key)
 
-        if key_ in self.holding or key_ in self.holding_direction:
-            return
+        with self.lock:
+            if not self.enabled or key_ in self.holding or key_ in self.holding_direction:
+                return
 
-        for k in self.key_map.keys():
-            if key_ == k and key_ in self.direction_key:
-                self.holding_direction.append(key_)
-                self.press_direction(self.holding_direction)
-            elif key_ == k:
-                self.input.press(self.key_map[k])
-                self.holding.append(key_)
+            command = self.buttons.get(key_)
+            if command is not None:
+                self.holding.add(key_)
+                self.input.press(command)
+            elif key_ in self.directions:
+                self.holding_direction[key_] = self.directions[key_]
+                self.press_direction()
+            else:
+                return
+        self.latency.append(perf_counter() - started)
 
     def on_release(self, key):
+        started = perf_counter()
+
         if key is None:
             logger.warning('unknown key has released')
 
-        try:
-            key_ = key.char
-        # for special keys
-        except AttributeError:
-            key_ = key
-
-        if key_ in self.holding_direction:
-            self.holding_direction.remove(key_)
-            self.input.press_end(self.key_map[key_])
-            self.press_direction(self.holding_direction)
-        elif key_ in self.holding:
-            self.holding.remove(key_)
-            self.input.press_end(self.key_map[key_])
-
-    def press_direction(self, direction):
-        if len(direction) == 0:
-            return
-        elif len(direction) == 1:
-            self.input.press(self.key_map[direction[0]])
-        elif len(direction) > 1:
-            valid_direction = direction[-2:]  # set only last 2 directions
-
-            if self.inverse_lookup(Direction.UP) in valid_direction:
-                if self.inverse_lookup(Direction.RIGHT) in valid_direction:
-                    self.input.press(Direction.UP_RIGHT)
-                elif self.inverse_lookup(Direction.LEFT) in valid_direction:
-                    self.input.press(Direction.UP_LEFT)
-            elif self.inverse_lookup(Direction.DOWN) in valid_direction:
-                if self.inverse_lookup(Direction.RIGHT) in valid_direction:
-                    self.input.press(Direction.DOWN_LEFT)
-                elif self.inverse_lookup(Direction.LEFT) in valid_direction:
-                    self.input.press(Direction.DOWN_RIGHT)
+        # special keys do not have char
+        key_ = getattr(key, 'char', key)
+
+        with self.lock:
+            if not self.enabled:
+                return
+
+            if key_ in self.holding_direction:
+                self.input.press_end(self.holding_direction.pop(key_))
+                self.press_direction()
+            elif key_ in self.holding:
+                self.holding.remove(key_)
+                self.input.press_end(self.buttons[key_])
+            else:
+                return
+        self.latency.append(perf_counter() - started)
+
+    def press_direction(self):
+        if len(self.holding_direction) == 1:
+            self.input.press(next(iter(self.holding_direction.values())))
+        elif len(self.holding_direction) > 1:
+            # set only last 2 directions
+            valid_direction = frozenset(list(self.holding_direction)[-2:])
+            diagonal = self.diagonals.get(valid_direction)
+            if diagonal is not None:
+                self.input.press(diagonal)
+
+    # Log the time from the key callbacks (presses and releases) to the end of the serial writes
+    # キーイベントの受信からシリアル書き込み完了までの時間を出力します
+    def report(self):
+        if not self.latency:
+            return None
+        values = sorted(self.latency)
+        result = {
+            'count': len(values),
+            'mean': sum(values) / len(values),
+            'p95': values[min(int(len(values) * 0.95), len(values) - 1)],
+            'max': values[-1],
+        }
+        logger.info(f'keyboard latency: mean {result["mean"] * 1000:.2f} ms, '
+                    f'p95 {result["p95"] * 1000:.2f} ms, max {result["max"] * 1000:.2f} ms '
+                    f'({result["count"]} events)')
+        return result
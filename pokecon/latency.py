@@ -0,0 +1,129 @@
+import threading
+from configparser import ConfigParser
+from dataclasses import dataclass, fields
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+
+from pokecon.framecache import signature
+from pokecon.logger import get_logger
+from pokecon.stats import percentile
+from pokecon.template import REFERENCE_SIZE
+
+
+LATENCY_PATH = Path('conf/latency.ini')
+
+
+logger = get_logger(__name__)
+
+
+# Seconds from a serial write until the change is visible in a captured frame,
+# measured by scripts/latency.py on this TV, capture card and console
+# 入力から画面に反映されるまでの時間(scripts/latency.pyで測定します)
+@dataclass
+class Latency:
+    samples: int = 0
+    min: float = 0.0
+    p50: float = 0.0
+    p95: float = 0.0
+    max: float = 0.0
+    fps: float = 0.0
+
+    @property
+    def calibrated(self):
+        return self.samples > 0
+
+    # time to wait for an input to show, the p95 of the calibration or `default` before it is calibrated
+    # 測定済みならp95、未測定ならdefaultを返します
+    def reaction(self, default=0.5):
+        return self.p95 if self.calibrated else default
+
+    # in capture frames
+    def frames(self, seconds):
+        return seconds * self.fps
+
+    @classmethod
+    def of(cls, latencies, fps):
+        return cls(len(latencies), min(latencies), percentile(latencies, 0.5), percentile(latencies, 0.95),
+                   max(latencies), fps)
+
+    def text(self):
+        return ', '.join(f'{k} {getattr(self, k) * 1000:.1f} ms ({self.frames(getattr(self, k)):.1f} f)'
+                         for k in ('min', 'p50', 'p95', 'max'))
+
+
+def load_latency(path=LATENCY_PATH):
+    latency = Latency()
+    if path.exists():
+        config = ConfigParser()
+        config.read(path, encoding='utf-8')
+        if config.has_section('latency'):
+            for f in fields(Latency):
+                if config.has_option('latency', f.name):
+                    setattr(latency, f.name, f.type(config.get('latency', f.name)))
+    return latency
+
+
+def save_latency(latency, path=LATENCY_PATH):
+    path.parent.mkdir(exist_ok=True)
+    config = ConfigParser()
+    config['latency'] = {f.name: str(getattr(latency, f.name)) for f in fields(Latency)}
+    with open(path, 'w', encoding='utf-8') as f:
+        config.write(f)
+
+
+# Capture sink that notices the first frame after `arm` whose area differs from the last frame before it,
+# the area [x1, x2, y1, y2] is given at 1920x1080
+# 指定した範囲が変化した最初のフレームを検出します
+class ChangeProbe:
+    def __init__(self, area=None, threshold=10.0):
+        self.area = area
+        # mean absolute difference (0 to 255) of the sampled pixels
+        self.threshold = threshold
+        self.lock = threading.Lock()
+        self.changed = threading.Event()
+        self.current = None
+        self.baseline = None
+        self.since = None
+        self.hit = None
+
+    def crop(self, frame):
+        if self.area is None:
+            return frame
+        scale = frame.shape[1] / REFERENCE_SIZE[0]
+        x1, x2, y1, y2 = [int(round(v * scale)) for v in self.area]
+        return frame[y1:y2, x1:x2]
+
+    # capture sink, called on the thread reading the capture
+    def publish(self, frame_id, timestamp, frame):
+        current = signature(self.crop(frame))
+        with self.lock:
+            self.current = current
+            if self.since is None or self.hit is not None or timestamp <= self.since:
+                return
+            if np.abs(current - self.baseline).mean() > self.threshold:
+                self.hit = (frame_id, timestamp)
+                self.changed.set()
+
+    # compare the frames after `since` (perf_counter() by default) with the latest one, call right before the write
+    def arm(self, since=None):
+        with self.lock:
+            if self.current is None:
+                return False
+            self.baseline = self.current
+            self.since = perf_counter() if since is None else since
+            self.hit = None
+            self.changed.clear()
+            return True
+
+    def changed_frame(self):
+        with self.lock:
+            return self.hit
+
+    # (frame_id, timestamp) of the changed frame or None on timeout
+    def wait(self, timeout=1.0):
+        self.changed.wait(timeout)
+        with self.lock:
+            self.since = None
+            return self.hit
@@ -1,10 +1,72 @@
+import atexit
 import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+
+
+FORMAT = '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
+
+
+_listener = None
+
+
+# Puts records on a bounded queue without formatting them on the caller's thread.
+# NOTE: records keep their arguments until a handler formats them on the listener thread,
+#       so do not mutate objects after passing them to the logger
+class LazyQueueHandler(QueueHandler):
+    def __init__(self, queue_):
+        super().__init__(queue_)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# Configure the root logger once, handlers run on a background thread
+# ルートロガーを設定します(ハンドラーはバックグラウンドスレッドで動作します)
+def setup_logging(level=logging.DEBUG, maxsize=10000):
+    global _listener
+    if _listener is not None:
+        return
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter(FORMAT))
+    console.setLevel(level)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(LazyQueueHandler(queue.Queue(maxsize)))
+    _listener = QueueListener(root.handlers[-1].queue, console, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+# Add a handler that runs on the listener thread (or directly on the root logger without setup)
+def add_handler(handler):
+    if _listener is None:
+        logging.getLogger().addHandler(handler)
+    else:
+        _listener.handlers = _listener.handlers + (handler,)
+
+
+def remove_handler(handler):
+    if _listener is None:
+        logging.getLogger().removeHandler(handler)
+    else:
+        _listener.handlers = tuple(h for h in _listener.handlers if h is not handler)
 
 
 def get_logger(name):
-    logging.basicConfig(
-        level=logging.DEBUG,
-        format='%(asctime)s [%(levelname)s] %(name)s: %(message)s'
-    )
     logger = logging.getLogger(name)
     return logger
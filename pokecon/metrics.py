@@ -0,0 +1,190 @@
+import threading
+from bisect import bisect_left
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+from pokecon.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+
+# metrics in the order they are rendered
+REGISTRY = []
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return '{' + ','.join(f'{n}="{v}"' for n, v in zip(names, escaped)) + '}'
+
+
+# Updates only take an uncontended lock and a dict lookup, everything else is done on a scrape
+class Metric:
+    TYPE = None
+
+    def __init__(self, name, help_, labels=()):
+        self.name = name
+        self.help = help_
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+        REGISTRY.append(self)
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.TYPE}']
+        for name, key, value in self.samples():
+            lines.append(f'{name}{_labels(self.labels, key)} {value}')
+        return lines
+
+
+class Counter(Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+# `function` is called on a scrape instead of keeping a value
+class Gauge(Metric):
+    TYPE = 'gauge'
+
+    def __init__(self, name, help_, labels=(), function=None):
+        super().__init__(name, help_, labels)
+        self.function = function
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def samples(self):
+        if self.function is None:
+            return super().samples()
+        value = self.function()
+        return [] if value is None else [(self.name, (), value)]
+
+
+class Histogram(Metric):
+    TYPE = 'histogram'
+    BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+    def __init__(self, name, help_, labels=(), buckets=BUCKETS):
+        super().__init__(name, help_, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.TYPE}']
+        names = self.labels + ('le',)
+        with self.lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_labels(names, key + (bound,))} {cumulative}')
+            lines.append(f'{self.name}_sum{_labels(self.labels, key)} {total}')
+            lines.append(f'{self.name}_count{_labels(self.labels, key)} {cumulative}')
+        return lines
+
+
+# Rate of the last `size` events, for fps which is hard to read from a counter by eye
+class RateMeter:
+    def __init__(self, size=120):
+        self.times = deque(maxlen=size)
+
+    def tick(self, now=None):
+        self.times.append(perf_counter() if now is None else now)
+
+    def rate(self):
+        times = list(self.times)
+        if len(times) < 2 or times[-1] == times[0]:
+            return None
+        # stale when nothing happened for a while
+        if perf_counter() - times[-1] > 1.0:
+            return 0.0
+        return (len(times) - 1) / (times[-1] - times[0])
+
+
+def render():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+capture_fps = RateMeter()
+display_fps = RateMeter()
+# set by the window to the capture it shows
+capture_source = None
+
+
+def _frame_age():
+    cap = capture_source
+    if cap is None or cap.timestamp is None:
+        return None
+    return perf_counter() - cap.timestamp
+
+
+capture_frames = Counter('pokecon_capture_frames_total', 'Frames read from the capture device')
+Gauge('pokecon_capture_fps', 'Frames read per second', function=capture_fps.rate)
+Gauge('pokecon_capture_frame_age_seconds', 'Seconds since the latest frame was read', function=_frame_age)
+display_frames = Counter('pokecon_display_frames_total', 'Frames shown in the preview')
+Gauge('pokecon_display_fps', 'Frames shown per second', function=display_fps.rate)
+serial_reports = Counter('pokecon_serial_reports_total', 'Reports written to the serial port')
+serial_bytes = Counter('pokecon_serial_bytes_total', 'Bytes written to the serial port')
+match_total = Counter('pokecon_template_matches_total', 'Template matches', ('template',))
+match_seconds = Histogram('pokecon_template_match_seconds', 'Time of a template match', ('template',))
+script_iterations = Counter('pokecon_script_iterations_total',
+                            'Script loop iterations (waits, presses and checks)', ('script',))
+script_exceptions = Counter('pokecon_script_exceptions_total', 'Exceptions caught in do_safe',
+                            ('script', 'exception'))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format_, *args):
+        pass
+
+
+# Serves the metrics in the Prometheus text format on localhost
+# メトリクスをPrometheusのテキスト形式で公開します(http://127.0.0.1:9108/metrics)
+class MetricsServer:
+    def __init__(self, port=9108, host='127.0.0.1'):
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        host, port = self.server.server_address[:2]
+        logger.info(f'metrics: http://{host}:{port}/metrics')
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -1,10 +1,8 @@
 import logging
+from collections import deque
 
 from PySide2.QtCore import (
-    QObject,
-    Qt,
-    Signal,
-    Slot
+    Qt
 )
 from PySide2.QtGui import (
     QTextCursor
@@ -18,21 +16,29 @@ from PySide2.QtWidgets import (
 )
 
 
-class QTextSignal(QObject):
-    message = Signal(str)
-
-
-class SignalHandler(logging.Handler):
-    def __init__(self):
+# Keeps the latest records for the GUI, which drains them in batches on a timer
+# GUIがタイマーでまとめて取り出すまでログレコードを保持します
+class LogBuffer(logging.Handler):
+    def __init__(self, capacity=1000):
         super().__init__()
-        self.emitter = QTextSignal()
+        self.records = deque(maxlen=capacity)
 
     def emit(self, record):
-        msg = self.format(record)
-        self.emitter.message.emit(msg)
+        self.records.append(record)
+
+    def drain(self):
+        records = []
+        try:
+            while True:
+                records.append(self.records.popleft())
+        except IndexError:
+            pass
+        return records
 
 
 class InfoWindow(QWidget):
+    MAX_LINES = 5000
+
     def __init__(self, parent=None):
         super().__init__(parent)
         self.setWindowTitle('Info')
@@ -48,14 +54,10 @@ class InfoWindow(QWidget):
         self.editor = QPlainTextEdit()
         self.editor.setReadOnly(True)
         self.editor.setSizePolicy(QSizePolicy.Preferred, QSizePolicy.Expanding)
+        # old lines are dropped so that memory and repaint cost stay flat on long runs
+        self.editor.setMaximumBlockCount(self.MAX_LINES)
 
-        self.logger = logging.getLogger()
-        formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(name)s:\n%(message)s\n')
-        self.signal_handler = SignalHandler()
-        self.signal_handler.setFormatter(formatter)
-        self.signal_handler.setLevel(logging.INFO)
-        self.signal_handler.emitter.message.connect(self.write)
-        self.logger.addHandler(self.signal_handler)
+        self.formatter = logging.Formatter('%(asctime)s [%(levelname)s] %(name)s:\n%(message)s\n')
 
         layout.addWidget(self.editor)
 
@@ -65,10 +67,9 @@ class InfoWindow(QWidget):
 
         self.button.clicked.connect(self.clear_log)
 
-    @Slot(str)
-    def write(self, msg):
+    def write(self, records):
         self.editor.moveCursor(QTextCursor.End)
-        self.editor.insertPlainText(msg + '\n')
+        self.editor.appendPlainText('\n'.join(self.formatter.format(r) for r in records))
         self.editor.moveCursor(QTextCursor.End)
 
     def clear_log(self):
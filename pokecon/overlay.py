@@ -0,0 +1,34 @@
+from collections import deque
+from dataclasses import dataclass
+from time import perf_counter
+
+
+@dataclass
+class Overlay:
+    # x, y, w, h in frame coordinates
+    rect: tuple
+    label: str
+    score: float
+    frame_id: int
+    expires: float
+
+
+# Matches publish what they found here, and the preview draws it only while it is visible
+# マッチング結果をプレビューに表示するためのチャンネル
+class OverlayChannel:
+    def __init__(self, ttl=1.0, capacity=64):
+        self.ttl = ttl
+        self.overlays = deque(maxlen=capacity)
+
+    def publish(self, rect, label='', score=0.0, frame_id=-1):
+        self.overlays.append(Overlay(rect, label, score, frame_id, perf_counter() + self.ttl))
+
+    def active(self):
+        now = perf_counter()
+        return [o for o in list(self.overlays) if o.expires > now]
+
+    def clear(self):
+        self.overlays.clear()
+
+
+overlays = OverlayChannel()
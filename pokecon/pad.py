@@ -1,3 +1,4 @@
+import logging
 import math
 from collections import OrderedDict
 from enum import IntFlag, IntEnum, Enum, auto
@@ -10,11 +11,31 @@ from pokecon.ports import SerialSender
 MIN = 0
 CENTER = 128
 MAX = 255
+# resolution of the angle tables, 0.1 degree
+ANGLE_STEPS = 3600
 
 
 logger = get_logger(__name__)
 
 
+# lookup tables so that streaming stick values costs no trigonometry or formatting per report
+COS = [math.cos(2 * math.pi * i / ANGLE_STEPS) for i in range(ANGLE_STEPS)]
+SIN = [math.sin(2 * math.pi * i / ANGLE_STEPS) for i in range(ANGLE_STEPS)]
+HEX = [format(v, 'x') for v in range(256)]
+
+
+# Stick values of an angle in degrees (0: right, 90: up) and a magnitude from 0 to 1,
+# y is already flipped for the report
+# 任意の角度と倒し具合からスティックの値を求めます
+def stick_values(degree, magnitude=1.0):
+    i = int(round(degree * ANGLE_STEPS / 360)) % ANGLE_STEPS
+    magnitude = min(max(magnitude, 0.0), 1.0)
+    # rounded half up, so that the magnitude 0 is CENTER on both axes (the epsilon absorbs sin(pi) != 0)
+    x = int(127.5 * COS[i] * magnitude + 128.0 + 1e-9)
+    y = int(128.0 - 127.5 * SIN[i] * magnitude + 1e-9)
+    return min(x, MAX), min(y, MAX)
+
+
 class Button(IntFlag):
     Y = auto()
     B = auto()
@@ -177,6 +198,23 @@ class SerialFormat:
                 self.format['rx'] = c.x
                 self.format['ry'] = 255 - c.y
 
+    # raw values of a stick, y as in the report (0 is up)
+    def set_stick(self, stick, x, y):
+        if stick == Stick.LEFT:
+            if self.format['lx'] != x or self.format['ly'] != y:
+                self.L_stick_changed = True
+            self.format['lx'], self.format['ly'] = x, y
+        else:
+            if self.format['rx'] != x or self.format['ry'] != y:
+                self.R_stick_changed = True
+            self.format['rx'], self.format['ry'] = x, y
+
+    # the report with only `stick` changed, followed by a placeholder for its values
+    def stick_prefix(self, stick):
+        send_btn = int(self.format['btn']) << 2 | (0x2 if stick == Stick.LEFT else 0x1)
+        head = format(send_btn, '#06x') + ' ' + str(int(self.format['hat']))
+        return head + ' {} {} ' if stick == Stick.LEFT else head + '  {} {}'
+
     def unset_direction(self, commands):
         if Tilt.UP in commands or Tilt.DOWN in commands:
             self.format['ly'] = CENTER
@@ -250,7 +288,8 @@ class Input:
                 commands.append(c)
 
         # print to log
-        logger.debug(commands)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('%s', commands)
 
         self.format.set_button([c for c in commands if type(c) is Button])
         self.format.set_hat([c for c in commands if type(c) is Hat])
@@ -273,6 +312,29 @@ class Input:
 
         self.ser.write(self.format.str)
 
+    # tilt a stick to any angle (degrees, 0: right, 90: up) and magnitude (0 to 1)
+    def tilt(self, stick, degree, magnitude=1.0):
+        self.format.set_stick(stick, *stick_values(degree, magnitude))
+        self.ser.write(self.format.str)
+
+    def center(self, stick):
+        self.format.set_stick(stick, CENTER, CENTER)
+        self.ser.write(self.format.str)
+
+    # Reports which move `stick` through the values (x, y), with the buttons currently pressed
+    def stick_rows(self, stick, values):
+        prefix = self.format.stick_prefix(stick)
+        return [prefix.format(HEX[x], HEX[y]) for x, y in values]
+
+    # write one of the rows made by stick_rows, the stick state follows the last values
+    def write_row(self, row, stick, x, y):
+        self.ser.write(row)
+        self.format.set_stick(stick, x, y)
+        if stick == Stick.LEFT:
+            self.format.L_stick_changed = False
+        else:
+            self.format.R_stick_changed = False
+
     def hold(self, commands):
         if not isinstance(commands, list):
             commands = [commands]
@@ -1,6 +1,7 @@
 from serial import Serial
 from serial.serialutil import SerialException
 
+from pokecon import metrics
 from pokecon.logger import get_logger
 
 
@@ -28,8 +29,11 @@ class SerialSender:
         return self.ser is not None and self.ser.isOpen()
 
     def write(self, row):
+        data = (row + '\r\n').encode('utf-8')
         try:
-            self.ser.write((row + '\r\n').encode('utf-8'))
+            self.ser.write(data)
+            metrics.serial_reports.inc()
+            metrics.serial_bytes.inc(len(data))
         except SerialException:
             logger.error('SerialException', exc_info=True)
         except AttributeError:
@@ -0,0 +1,180 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+from urllib.parse import parse_qs, urlparse
+
+import cv2
+import numpy as np
+
+from pokecon.logger import get_logger
+
+
+BOUNDARY = 'pokeconframe'
+
+
+logger = get_logger(__name__)
+
+
+# Encodes the captured frames for remote viewers.
+# Frames are scaled and JPEG-encoded at most once each, only while someone is watching,
+# and every viewer takes the latest JPEG at its own rate, so a slow viewer skips frames
+# キャプチャー画面をMJPEGで配信します(http://127.0.0.1:9109/)
+class PreviewServer:
+    def __init__(self, port=9109, width=640, quality=70, fps=30, host='127.0.0.1'):
+        self.width = width
+        self.quality = quality
+        # fps <= 0 publishes every frame
+        self.interval = 1 / fps if fps > 0 else 0.0
+        self.lock = threading.Lock()
+        self.encoded = threading.Condition()
+        self.viewers = 0
+        self.scaled = None
+        self.encoding = None
+        self.pending = None
+        self.last_publish = 0.0
+        self.jpeg = None
+        self.jpeg_id = -1
+        self.running = True
+        self.server = ThreadingHTTPServer((host, port), self.handler())
+        self.server.daemon_threads = True
+        self.threads = [threading.Thread(target=self.server.serve_forever, daemon=True),
+                        threading.Thread(target=self.encode, daemon=True)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+        host, port = self.server.server_address[:2]
+        logger.info(f'preview: http://{host}:{port}/')
+
+    def stop(self):
+        self.running = False
+        with self.encoded:
+            self.encoded.notify_all()
+        self.server.shutdown()
+        self.server.server_close()
+
+    # capture sink, only scales into a preallocated buffer, the encoder thread does the rest
+    def publish(self, frame_id, timestamp, frame):
+        if self.viewers == 0 or timestamp - self.last_publish < self.interval:
+            return
+        self.last_publish = timestamp
+        h, w = frame.shape[:2]
+        size = (self.width, max(int(h * self.width / w), 1))
+        with self.lock:
+            if self.scaled is None or self.scaled.shape[:2] != (size[1], size[0]):
+                self.scaled = np.empty((size[1], size[0]) + frame.shape[2:], np.uint8)
+            cv2.resize(frame, size, dst=self.scaled, interpolation=cv2.INTER_AREA)
+            self.pending = frame_id
+        with self.encoded:
+            self.encoded.notify_all()
+
+    def encode(self):
+        while self.running:
+            with self.encoded:
+                self.encoded.wait_for(lambda: self.pending is not None or not self.running)
+            # the small image is copied, so that the capture thread never waits for the encoder
+            with self.lock:
+                frame_id, self.pending = self.pending, None
+                if frame_id is None:
+                    continue
+                if self.encoding is None or self.encoding.shape != self.scaled.shape:
+                    self.encoding = np.empty_like(self.scaled)
+                np.copyto(self.encoding, self.scaled)
+            _, buf = cv2.imencode('.jpg', self.encoding, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+            with self.encoded:
+                self.jpeg, self.jpeg_id = buf.tobytes(), frame_id
+                self.encoded.notify_all()
+
+    # the first JPEG newer than `after`, or None on timeout
+    def next_jpeg(self, after, timeout=1.0):
+        with self.encoded:
+            self.encoded.wait_for(lambda: self.jpeg_id > after or not self.running, timeout)
+            if self.jpeg_id > after:
+                return self.jpeg_id, self.jpeg
+        return None
+
+    def add_viewer(self):
+        with self.lock:
+            self.viewers += 1
+
+    def remove_viewer(self):
+        with self.lock:
+            self.viewers -= 1
+
+    def handler(self):
+        preview = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if url.path == '/':
+                    self.send_page()
+                elif url.path == '/snapshot.jpg':
+                    self.send_snapshot()
+                elif url.path == '/stream.mjpg':
+                    try:
+                        fps = float(query.get('fps', ['10'])[0])
+                    except ValueError:
+                        self.send_error(400, 'fps must be a number')
+                        return
+                    if not fps > 0:
+                        self.send_error(400, 'fps must be positive')
+                        return
+                    self.send_stream(1 / max(fps, 0.1))
+                else:
+                    self.send_error(404)
+
+            def send_page(self):
+                body = b'<html><body style="margin:0;background:#000"><img src="/stream.mjpg"></body></html>'
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_snapshot(self):
+                preview.add_viewer()
+                try:
+                    # a fresh frame is encoded if nobody was watching
+                    item = preview.next_jpeg(preview.jpeg_id if preview.viewers == 1 else -1)
+                finally:
+                    preview.remove_viewer()
+                if item is None:
+                    self.send_error(503, 'no frame')
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(item[1])))
+                self.end_headers()
+                self.wfile.write(item[1])
+
+            def send_stream(self, interval):
+                self.send_response(200)
+                self.send_header('Content-Type', f'multipart/x-mixed-replace; boundary={BOUNDARY}')
+                self.end_headers()
+                preview.add_viewer()
+                last_id, due = -1, 0.0
+                try:
+                    while preview.running:
+                        # pace this viewer, frames encoded meanwhile are skipped
+                        delay = due - perf_counter()
+                        if delay > 0:
+                            with preview.encoded:
+                                preview.encoded.wait_for(lambda: not preview.running, delay)
+                        item = preview.next_jpeg(last_id)
+                        if item is None:
+                            continue
+                        last_id, jpeg = item
+                        due = perf_counter() + interval
+                        self.wfile.write(f'--{BOUNDARY}\r\nContent-Type: image/jpeg\r\n'
+                                         f'Content-Length: {len(jpeg)}\r\n\r\n'.encode() + jpeg + b'\r\n')
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    preview.remove_viewer()
+
+            def log_message(self, format_, *args):
+                pass
+
+        return Handler
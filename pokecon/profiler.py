@@ -0,0 +1,48 @@
+import threading
+from contextlib import contextmanager
+from time import perf_counter
+
+from pokecon.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+
+# Collects how long each startup phase took and on which thread
+# 起動時の各フェーズの所要時間を記録します
+class StartupProfile:
+    def __init__(self, enabled=False, origin=None):
+        self.enabled = enabled
+        self.origin = perf_counter() if origin is None else origin
+        self.phases = []
+        self.lock = threading.Lock()
+
+    def add(self, name, start, end):
+        with self.lock:
+            self.phases.append((name, threading.current_thread().name, start - self.origin, end - start))
+
+    @contextmanager
+    def phase(self, name):
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, start, perf_counter())
+
+    # record an instant event like "window shown"
+    def mark(self, name):
+        now = perf_counter()
+        self.add(name, now, now)
+
+    def report(self):
+        if not self.enabled:
+            return
+        with self.lock:
+            phases = sorted(self.phases, key=lambda p: p[2])
+        lines = ['startup profile:',
+                 f'  {"phase":<24}{"thread":<16}{"start[ms]":>10}{"took[ms]":>10}']
+        for name, thread, start, took in phases:
+            lines.append(f'  {name:<24}{thread:<16}{start * 1000:>10.1f}{took * 1000:>10.1f}')
+        total = max(start + took for _, _, start, took in phases) if phases else 0.0
+        lines.append(f'  total {total * 1000:.1f} ms')
+        logger.info('\n'.join(lines))
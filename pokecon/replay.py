@@ -0,0 +1,180 @@
+import csv
+from pathlib import Path
+
+import cv2
+
+from pokecon.archive import ArchiveReader
+from pokecon.capture import save_screenshot
+from pokecon.clock import Clock
+from pokecon.logger import get_logger
+
+
+logger = get_logger(__name__)
+
+
+# Frames of a video file, timestamps come from the container
+class VideoSource:
+    def __init__(self, path):
+        self.path = path
+        self.src = cv2.VideoCapture(str(path))
+        self.fps = self.src.get(cv2.CAP_PROP_FPS) or 60
+        self.w = int(self.src.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self.h = int(self.src.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    def next(self):
+        frame_id = int(self.src.get(cv2.CAP_PROP_POS_FRAMES))
+        ref, frame = self.src.read()
+        if not ref:
+            return None
+        return frame_id, self.src.get(cv2.CAP_PROP_POS_MSEC) / 1000, frame
+
+    def reset(self):
+        self.src.set(cv2.CAP_PROP_POS_FRAMES, 0)
+
+    def release(self):
+        self.src.release()
+
+
+# Frames saved as images in a directory.
+# frames.csv (frame_id,timestamp,file) gives ids and timestamps, otherwise files are played at `fps`
+class ImageSequenceSource:
+    def __init__(self, path, fps=60):
+        self.path = Path(path)
+        self.fps = fps
+        index = self.path.joinpath('frames.csv')
+        if index.exists():
+            with open(index, encoding='utf-8', newline='') as f:
+                self.frames = [(int(r['frame_id']), float(r['timestamp']), r['file']) for r in csv.DictReader(f)]
+        else:
+            files = sorted(p.name for p in self.path.iterdir() if p.suffix.lower() in ('.png', '.jpg', '.bmp'))
+            self.frames = [(i, i / fps, file) for i, file in enumerate(files)]
+        self.position = 0
+        first = cv2.imread(str(self.path.joinpath(self.frames[0][2]))) if self.frames else None
+        self.h, self.w = first.shape[:2] if first is not None else (0, 0)
+
+    def next(self):
+        if self.position >= len(self.frames):
+            return None
+        frame_id, timestamp, file = self.frames[self.position]
+        self.position += 1
+        return frame_id, timestamp, cv2.imread(str(self.path.joinpath(file)), cv2.IMREAD_COLOR)
+
+    def reset(self):
+        self.position = 0
+
+    def release(self):
+        pass
+
+
+# Frames of an archive written by ArchiveWriter, with the frame ids and timestamps of the live capture
+class ArchiveSource:
+    def __init__(self, path):
+        self.reader = ArchiveReader(path)
+        self.fps = self.reader.fps
+        self.w = self.reader.w
+        self.h = self.reader.h
+        self.position = 0
+
+    def next(self):
+        if self.position >= len(self.reader):
+            return None
+        frame_id, timestamp = self.reader.frame_info(self.position)
+        frame = self.reader.read(self.position)
+        self.position += 1
+        return frame_id, timestamp, frame
+
+    def reset(self):
+        self.position = 0
+
+    def release(self):
+        self.reader.close()
+
+
+def open_source(path):
+    path = Path(path)
+    if path.is_dir():
+        return ImageSequenceSource(path)
+    if path.suffix == '.pca':
+        return ArchiveSource(path)
+    return VideoSource(path)
+
+
+# Capture compatible backend which plays a recorded session
+#   realtime: frames are paced by their timestamps on the wall clock
+#   fast:     every read returns the next frame immediately
+#   clock:    frames are paced on the given clock (e.g. VirtualClock)
+# 録画したセッションを再生するキャプチャー
+class ReplayCapture:
+    REALTIME = 'realtime'
+    FAST = 'fast'
+    CLOCK = 'clock'
+
+    def __init__(self, path, mode=REALTIME, clock=None, loop=False, path_dir=Path('screenshot')):
+        self.source = open_source(path)
+        self.mode = mode
+        self.clock = clock if clock is not None else Clock()
+        if mode == self.CLOCK and clock is None:
+            raise ValueError('clock mode needs a clock')
+        self.loop = loop
+        self.w = self.source.w
+        self.h = self.source.h
+        self.fps = self.source.fps
+        self.ref = None
+        self.frame = None
+        self.frame_id = -1
+        self.timestamp = None
+        self.path_dir = path_dir
+        self.opened = True
+        # clock time of the timestamp 0
+        self.origin = None
+        self.next_frame = None
+        # timestamps keep increasing over loops so that pacing continues
+        self.offset = 0.0
+        self.last = 0.0
+
+    def fetch(self):
+        item = self.source.next()
+        if item is None and self.loop:
+            self.source.reset()
+            self.offset = self.last + 1 / self.fps
+            item = self.source.next()
+        if item is None:
+            return None
+        self.last = item[1] + self.offset
+        return item[0], self.last, item[2]
+
+    def read(self):
+        if self.next_frame is None:
+            self.next_frame = self.fetch()
+        if self.next_frame is None:
+            self.ref = False
+            return self.ref, None
+        if self.mode != self.FAST:
+            if self.origin is None:
+                self.origin = self.clock.time() - self.next_frame[1]
+            # like a device, wait for the next frame, and skip frames the consumer was too slow for
+            while True:
+                following = self.fetch()
+                if following is None or self.origin + following[1] > self.clock.time():
+                    break
+                self.next_frame = following
+            due = self.origin + self.next_frame[1] - self.clock.time()
+            if due > 0:
+                self.clock.sleep(due)
+        else:
+            following = self.fetch()
+        self.frame_id, self.timestamp, self.frame = self.next_frame
+        self.next_frame = following
+        self.ref = True
+        return self.ref, self.frame
+
+    def is_opened(self):
+        return self.opened
+
+    def release(self):
+        self.opened = False
+        self.source.release()
+
+    # frames of a replay are not pooled, so no lock is needed
+    def screenshot(self):
+        return save_screenshot(self.path_dir, self.frame)
@@ -0,0 +1,211 @@
+import threading
+import wave
+from pathlib import Path
+from time import perf_counter, sleep
+
+import numpy as np
+
+from pokecon.logger import get_logger
+
+
+SOUND_PATH = Path(__file__).parent.joinpath('../sounds/')
+
+
+logger = get_logger(__name__)
+
+
+# Read a wav file as mono float32 samples in [-1, 1]
+# wavファイルをモノラルのfloat32として読み込みます
+def read_wav(path):
+    with wave.open(str(path), 'rb') as f:
+        channels = f.getnchannels()
+        width = f.getsampwidth()
+        rate = f.getframerate()
+        data = f.readframes(f.getnframes())
+    if width == 1:
+        samples = (np.frombuffer(data, np.uint8).astype(np.float32) - 128) / 128
+    elif width == 2:
+        samples = np.frombuffer(data, np.int16).astype(np.float32) / 32768
+    elif width == 4:
+        samples = np.frombuffer(data, np.int32).astype(np.float32) / 2147483648
+    else:
+        raise ValueError(f'unsupported sample width: {width}')
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1, dtype=np.float32)
+    return samples, rate
+
+
+def resample(samples, src_rate, dst_rate):
+    if src_rate == dst_rate:
+        return samples
+    n = int(round(len(samples) * dst_rate / src_rate))
+    x = np.linspace(0, len(samples) - 1, n, dtype=np.float64)
+    return np.interp(x, np.arange(len(samples)), samples).astype(np.float32)
+
+
+# Ring buffer of mono samples with one writer (the audio callback) and one reader (the detector).
+# The writer only advances `written` after the samples are stored, so neither side takes a lock.
+# 音声コールバックと検出スレッドの間でロックを使わずにサンプルを受け渡すリングバッファ
+class RingBuffer:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buffer = np.zeros(capacity, dtype=np.float32)
+        self.written = 0
+
+    def write(self, samples):
+        total = len(samples)
+        if total > self.capacity:
+            samples = samples[-self.capacity:]
+        n = len(samples)
+        start = (self.written + total - n) % self.capacity
+        end = start + n
+        if end <= self.capacity:
+            self.buffer[start:end] = samples
+        else:
+            k = self.capacity - start
+            self.buffer[start:] = samples[:k]
+            self.buffer[:end - self.capacity] = samples[k:]
+        self.written += total
+
+    # copy absolute samples [start, stop)
+    def read(self, start, stop):
+        i, j = start % self.capacity, stop % self.capacity
+        if i < j or stop - start == 0:
+            return self.buffer[i:j].copy()
+        return np.concatenate((self.buffer[i:], self.buffer[:j]))
+
+
+class SoundTemplate:
+    def __init__(self, name, samples, threshold, block):
+        self.name = name
+        self.threshold = threshold
+        self.length = len(samples)
+        template = samples - samples.mean()
+        self.norm = float(np.linalg.norm(template))
+        # the FFT size is fixed by the block size, so the spectrum of the template is computed once
+        self.size = 1 << (self.length + block - 1 + self.length - 1).bit_length()
+        self.spectrum = np.conj(np.fft.rfft(template, self.size))
+        self.last_hit = -self.length
+
+
+# Detects reference sounds in the capture audio using FFT based normalized cross-correlation
+# キャプチャー音声からリファレンス音をFFTによる正規化相互相関で検出します
+class SoundDetector:
+    def __init__(self, rate=44100, channels=2, seconds=10.0, block=0.05):
+        self.rate = rate
+        self.channels = channels
+        self.block = int(rate * block)
+        self.ring = RingBuffer(int(rate * seconds))
+        self.templates = {}
+        self.position = 0
+        self.hits = {}
+        self.scores = {}
+        self.condition = threading.Condition()
+        self.thread = None
+        self.alive = False
+
+    def add(self, name, samples, rate, threshold=0.6):
+        samples = resample(np.asarray(samples, dtype=np.float32), rate, self.rate)
+        if len(samples) >= self.ring.capacity // 2:
+            raise ValueError(f'sound {name} is too long for the ring buffer')
+        self.templates[name] = SoundTemplate(name, samples, threshold, self.block)
+        self.hits.setdefault(name, 0)
+
+    def load(self, path_dir=SOUND_PATH, threshold=0.6):
+        for path in sorted(Path(path_dir).glob('*.wav')):
+            samples, rate = read_wav(path)
+            self.add(path.stem, samples, rate, threshold)
+            logger.debug(f'loaded sound {path.stem}')
+        return len(self.templates)
+
+    # NOTE: called on the audio callback thread, so this only converts and stores samples
+    def feed(self, data):
+        samples = np.frombuffer(data, np.int16)
+        if self.channels > 1:
+            samples = samples.reshape(-1, self.channels).mean(axis=1, dtype=np.float32)
+        self.ring.write(samples * np.float32(1 / 32768))
+
+    # Run detection over the samples fed since the last call and return names of detected sounds
+    def process(self):
+        if not self.templates:
+            self.position = self.ring.written
+            return []
+        longest = max(t.length for t in self.templates.values())
+        written = self.ring.written
+        oldest = written - self.ring.capacity + longest + self.block
+        if self.position < oldest:
+            logger.warning(f'sound detector is behind, skipped {oldest - self.position} samples')
+            self.position = oldest
+        detected = []
+        while written - self.position >= self.block:
+            for t in self.templates.values():
+                if self.match(t, self.position):
+                    detected.append(t.name)
+            self.position += self.block
+        return detected
+
+    def match(self, t, position):
+        # NOTE: before the buffer wraps, samples at negative positions are zeros
+        start = position - t.length + 1
+        x = self.ring.read(start, position + self.block)
+        corr = np.fft.irfft(np.fft.rfft(x, t.size) * t.spectrum, t.size)[:self.block]
+        # sliding energy of the signal, subtracted by its mean, for each window
+        c1 = np.concatenate(([0.0], np.cumsum(x, dtype=np.float64)))
+        c2 = np.concatenate(([0.0], np.cumsum(np.square(x, dtype=np.float64))))
+        s1 = c1[t.length:] - c1[:-t.length]
+        s2 = c2[t.length:] - c2[:-t.length]
+        energy = np.sqrt(np.maximum(s2 - s1 * s1 / t.length, 0.0)) * t.norm
+        score = np.divide(corr, energy, out=np.zeros_like(energy), where=energy > 1e-6)
+        i = int(np.argmax(score))
+        self.scores[t.name] = float(score[i])
+        hit = start + i
+        if score[i] > t.threshold and hit >= t.last_hit + t.length:
+            t.last_hit = hit
+            with self.condition:
+                self.hits[t.name] += 1
+                self.condition.notify_all()
+            logger.debug(f'detected sound {t.name} at {hit / self.rate:.3f}s (score: {score[i]:.3f})')
+            return True
+        return False
+
+    def run(self):
+        while self.alive:
+            started = perf_counter()
+            self.process()
+            elapsed = perf_counter() - started
+            sleep(max(self.block / self.rate - elapsed, 0.001))
+
+    def start(self):
+        if self.thread is None:
+            self.alive = True
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.alive = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    # Wait until the sound is detected more than `since` times (default: after this call),
+    # returns False on timeout
+    def wait_for(self, name, timeout=None, since=None):
+        if name not in self.templates:
+            raise KeyError(f'unknown sound: {name}')
+        with self.condition:
+            count = self.hits[name] if since is None else since
+            return self.condition.wait_for(lambda: self.hits[name] > count, timeout)
+
+    # Feed a wav file instead of a live device and return names of detected sounds
+    # 実機の代わりにwavファイルを入力します
+    def feed_wav(self, path):
+        samples, rate = read_wav(path)
+        samples = resample(samples, rate, self.rate)
+        detected = []
+        for i in range(0, len(samples), self.block):
+            self.ring.write(samples[i:i + self.block])
+            detected.extend(self.process())
+        # flush the tail so that a sound at the very end is checked too
+        self.ring.write(np.zeros(self.block, dtype=np.float32))
+        detected.extend(self.process())
+        return detected
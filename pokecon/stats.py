@@ -0,0 +1,119 @@
+import datetime
+import json
+import threading
+from collections import deque
+from pathlib import Path
+
+from pokecon.logger import get_logger
+
+
+STATS_PATH = Path('stats')
+
+
+logger = get_logger(__name__)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(round(q * (len(values) - 1))), len(values) - 1)]
+
+
+# Named counters and cycle times of a script run, timed on the script's clock
+# so that runs on the emulator are comparable with real ones
+# スクリプトのカウンターと1周の時間を集計します
+class ScriptStats:
+    def __init__(self, name, clock, window=3600.0, samples=1000):
+        self.name = name
+        self.clock = clock
+        # rates are measured over the last `window` seconds
+        self.window = window
+        self.started = clock.time()
+        self.counters = {}
+        self.events = {}
+        self.cycles = deque(maxlen=samples)
+        self.cycle_count = 0
+        self.last_cycle = None
+        # path of the summary once saved
+        self.saved = None
+        # the script thread updates, the GUI and the control API read
+        self.lock = threading.RLock()
+
+    def count(self, name, n=1):
+        now = self.clock.time()
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+            events = self.events.setdefault(name, deque(maxlen=100000))
+            events.append((now, n))
+            while events and events[0][0] < now - self.window:
+                events.popleft()
+
+    # mark the start of a loop iteration, the time since the previous mark is its cycle time
+    def cycle(self):
+        now = self.clock.time()
+        with self.lock:
+            if self.last_cycle is not None:
+                self.cycles.append(now - self.last_cycle)
+                self.cycle_count += 1
+                self.count('cycles')
+            self.last_cycle = now
+
+    def used(self):
+        return bool(self.counters) or self.last_cycle is not None
+
+    def elapsed(self):
+        return self.clock.time() - self.started
+
+    # per hour over the rolling window
+    def rate(self, name):
+        now = self.clock.time()
+        span = min(now - self.started, self.window)
+        if span <= 0:
+            return 0.0
+        with self.lock:
+            total = sum(n for t, n in self.events.get(name, ()) if t >= now - self.window)
+        return total * 3600 / span
+
+    def summary(self):
+        with self.lock:
+            return self._summary()
+
+    def _summary(self):
+        cycles = list(self.cycles)
+        return {
+            'script': self.name,
+            'elapsed': self.elapsed(),
+            'counters': dict(self.counters),
+            'rates_per_hour': {name: self.rate(name) for name in self.counters},
+            'cycles': self.cycle_count,
+            'cycle_p50': percentile(cycles, 0.5),
+            'cycle_p95': percentile(cycles, 0.95),
+            'cycle_mean': sum(cycles) / len(cycles) if cycles else None,
+        }
+
+    # one line for the status bar
+    def text(self):
+        with self.lock:
+            return self._text()
+
+    def _text(self):
+        parts = [f'{name}: {value} ({self.rate(name):.0f}/h)'
+                 for name, value in self.counters.items() if name != 'cycles']
+        cycles = list(self.cycles)
+        if cycles:
+            parts.append(f'cycle p50 {percentile(cycles, 0.5):.2f} s, p95 {percentile(cycles, 0.95):.2f} s '
+                         f'({self.rate("cycles"):.0f}/h)')
+        return ' | '.join(parts)
+
+    def save(self, path_dir=STATS_PATH):
+        summary = self.summary()
+        path_dir.mkdir(parents=True, exist_ok=True)
+        name = ''.join(c if c.isalnum() else '_' for c in self.name)
+        path = path_dir.joinpath(f'{datetime.datetime.now():%Y%m%d%H%M%S}_{name}.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        self.saved = path
+        logger.info(f'{self.name}: {self.text()}')
+        logger.info(f'saved stats: {path.name}')
+        return path
@@ -0,0 +1,149 @@
+import threading
+from pathlib import Path
+
+import cv2
+
+from pokecon.atlas import open_atlas
+from pokecon.logger import get_logger
+
+
+TEMPLATE_PATH = Path(__file__).parent.joinpath('../templates/')
+# templates and areas are authored at this capture size
+REFERENCE_SIZE = (1920, 1080)
+
+
+logger = get_logger(__name__)
+
+
+# Templates authored at the reference size, scaled to the live capture size and cached.
+# Scaled images are cached per (path, gray, tmpl_area, scale), when the capture size changes
+# the templates used so far are rebuilt for the new scale in the background
+# Images found in the atlas (see pokecon.atlas) are read from it instead of the PNGs
+# 基準解像度で作ったテンプレートをキャプチャーの解像度に合わせて拡大縮小し、キャッシュします
+class TemplateCache:
+    def __init__(self, path_dir=TEMPLATE_PATH, reference=REFERENCE_SIZE, atlas=True):
+        self.path_dir = Path(path_dir)
+        self.reference = reference
+        self.scale = 1.0
+        self.lock = threading.Lock()
+        self.originals = {}
+        self.scaled = {}
+        self.rebuilding = None
+        self.use_atlas = atlas
+        self.atlas = None
+        self.atlas_opened = False
+        # held while the atlas is opened or built, other threads keep using the scaled cache
+        self.atlas_lock = threading.Lock()
+
+    # opened on first use, rebuilt first if a PNG is newer
+    def get_atlas(self):
+        if self.use_atlas and not self.atlas_opened:
+            with self.atlas_lock:
+                if not self.atlas_opened:
+                    self.atlas = open_atlas(self.path_dir)
+                    self.atlas_opened = True
+        return self.atlas
+
+    def original(self, template_path, gray):
+        key = (str(template_path), gray)
+        image = self.originals.get(key)
+        if image is None:
+            atlas = self.get_atlas()
+            image = atlas.get(template_path, gray) if atlas is not None else None
+            if image is None:
+                path = self.path_dir / template_path
+                image = cv2.imread(str(path), cv2.IMREAD_GRAYSCALE if gray else cv2.IMREAD_COLOR)
+                if image is None:
+                    raise FileNotFoundError(f'template not found: {path}')
+            with self.lock:
+                self.originals[key] = image
+        return image
+
+    def build(self, template_path, gray, tmpl_area, scale):
+        image = self.original(template_path, gray)
+        if tmpl_area:
+            image = image[tmpl_area[2]:tmpl_area[3], tmpl_area[0]:tmpl_area[1]]
+        if scale != 1.0:
+            w, h = max(int(round(image.shape[1] * scale)), 1), max(int(round(image.shape[0] * scale)), 1)
+            image = cv2.resize(image, (w, h), interpolation=cv2.INTER_AREA if scale < 1.0 else cv2.INTER_LINEAR)
+        return image
+
+    def get(self, template_path, gray=True, tmpl_area=None, scale=None):
+        scale = self.scale if scale is None else scale
+        key = (str(template_path), gray, tuple(tmpl_area) if tmpl_area else None, round(scale, 4))
+        image = self.scaled.get(key)
+        if image is None:
+            atlas = self.get_atlas()
+            image = atlas.get(template_path, gray, tmpl_area, scale) if atlas is not None else None
+            if image is None:
+                image = self.build(template_path, gray, tmpl_area, scale)
+            with self.lock:
+                self.scaled[key] = image
+        return image
+
+    # build the templates at load time so that the first checks do not pay for it
+    def preload(self, template_paths, gray=True, band=0, step=0.05):
+        for template_path in template_paths:
+            for scale in self.scales(band, step):
+                self.get(template_path, gray, scale=scale)
+
+    # follow the size of the captured frames
+    def update_size(self, w, h):
+        scale = round(w / self.reference[0], 4)
+        if scale == self.scale:
+            return
+        logger.info(f'template scale: {self.scale} -> {scale} ({w}x{h})')
+        self.scale = scale
+        self.rebuilding = threading.Thread(target=self.rebuild, args=(scale,), daemon=True)
+        self.rebuilding.start()
+
+    # warm the cache for the new scale and drop the entries of other scales
+    def rebuild(self, scale):
+        with self.lock:
+            used = {key[:3] for key in self.scaled}
+        for template_path, gray, tmpl_area in used:
+            if self.scale != scale:
+                return
+            self.get(template_path, gray, tmpl_area, scale)
+        with self.lock:
+            self.scaled = {key: image for key, image in self.scaled.items() if key[3] == scale}
+
+    # scales around the live one, for captures which are cropped or scaled a little
+    def scales(self, band=0, step=0.05):
+        return [self.scale * (1 + i * step) for i in range(-band, band + 1)]
+
+    # [x1, x2, y1, y2] at the reference size to the live size
+    def scale_area(self, area):
+        if not area or self.scale == 1.0:
+            return area
+        return [int(round(v * self.scale)) for v in area]
+
+    # the atlas is checked again on the next use, called by the reload button after templates are edited
+    def clear(self):
+        with self.lock:
+            self.originals.clear()
+            self.scaled.clear()
+        with self.atlas_lock:
+            if self.atlas is not None:
+                self.atlas.close()
+            self.atlas = None
+            self.atlas_opened = False
+
+
+# shared by all scripts
+templates = TemplateCache()
+
+
+# Match a template against the frame over the scales of the band, returns (max_val, max_loc, (w, h))
+# of the best scale, or None if the template is larger than the frame at every scale
+def match_template(src, cache, template_path, gray=True, tmpl_area=None, band=0, step=0.05):
+    best = None
+    for scale in cache.scales(band, step):
+        templ = cache.get(template_path, gray, tmpl_area, scale)
+        if templ.shape[0] > src.shape[0] or templ.shape[1] > src.shape[1]:
+            continue
+        res = cv2.matchTemplate(src, templ, cv2.TM_CCOEFF_NORMED)
+        _, max_val, _, max_loc = cv2.minMaxLoc(res)
+        if best is None or max_val > best[0]:
+            best = (max_val, max_loc, (templ.shape[1], templ.shape[0]))
+    return best
@@ -0,0 +1,66 @@
+from dataclasses import dataclass
+from typing import List, Tuple
+
+import numpy as np
+
+from pokecon.pad import ANGLE_STEPS, COS, SIN, Stick
+
+
+# rate of the reports, the controller is polled at 125 Hz but the game reads it once per frame
+RATE = 60
+
+_COS = np.array(COS)
+_SIN = np.array(SIN)
+
+
+# (x, y) stick values of the report for arrays of angles in degrees and magnitudes from 0 to 1
+def polar_values(degrees, magnitudes):
+    i = np.rint(np.asarray(degrees) * ANGLE_STEPS / 360).astype(np.int64) % ANGLE_STEPS
+    m = np.clip(np.asarray(magnitudes, dtype=np.float64), 0.0, 1.0)
+    return _to_values(_COS[i] * m, _SIN[i] * m)
+
+
+# x, y from -1 to 1 (up is positive y) to stick values of the report
+def _to_values(xs, ys):
+    # rounded half up like stick_values
+    xs = np.clip(np.floor(127.5 * np.asarray(xs) + 128.0 + 1e-9), 0, 255).astype(int)
+    ys = np.clip(np.floor(128.0 - 127.5 * np.asarray(ys) + 1e-9), 0, 255).astype(int)
+    return list(zip(xs.tolist(), ys.tolist()))
+
+
+def _count(duration, rate):
+    return max(int(round(duration * rate)), 1)
+
+
+# Stick values sent one after another at `rate` reports per second
+# 一定の間隔で送るスティックの値の列
+@dataclass
+class Trajectory:
+    stick: Stick
+    values: List[Tuple[int, int]]
+    rate: int = RATE
+
+    @property
+    def duration(self):
+        return len(self.values) / self.rate
+
+
+# straight move between two vectors given as (x, y) from -1 to 1, e.g. a camera pan
+def line(stick, start, end, duration, rate=RATE):
+    t = np.linspace(0.0, 1.0, _count(duration, rate))
+    xs = start[0] + (end[0] - start[0]) * t
+    ys = start[1] + (end[1] - start[1]) * t
+    return Trajectory(stick, _to_values(xs, ys), rate)
+
+
+# constant magnitude from one angle to another in degrees, e.g. walking in a circle
+def arc(stick, start_degree, end_degree, duration, magnitude=1.0, rate=RATE):
+    n = _count(duration, rate)
+    return Trajectory(stick, polar_values(np.linspace(start_degree, end_degree, n), np.full(n, magnitude)), rate)
+
+
+# `turns` rotations (negative for clockwise) while the magnitude changes
+def spiral(stick, turns, duration, start_magnitude=0.0, end_magnitude=1.0, start_degree=0.0, rate=RATE):
+    n = _count(duration, rate)
+    degrees = start_degree + np.linspace(0.0, 360.0 * turns, n)
+    return Trajectory(stick, polar_values(degrees, np.linspace(start_magnitude, end_magnitude, n)), rate)
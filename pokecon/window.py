@@ -1,6 +1,9 @@
+import datetime
 import logging
+import os
+import threading
+from time import perf_counter
 
-import pyaudio
 from PySide2.QtCore import (
     QEvent,
     QObject,
@@ -12,8 +15,11 @@ from PySide2.QtCore import (
     Slot
 )
 from PySide2.QtGui import (
+    QColor,
     QIcon,
     QImage,
+    QPainter,
+    QPen,
     QPixmap,
     QDesktopServices
 )
@@ -30,19 +36,142 @@ from PySide2.QtWidgets import (
     QWidget
 )
 
-from pokecon.capture import Capture
-from pokecon.command import ImageProcPythonCommand
+from pokecon import metrics
 from pokecon.config import Config
-from pokecon.keybord import KeyboardController
-from pokecon.monitor import InfoWindow, SignalHandler
+from pokecon.logger import add_handler, get_logger, remove_handler
+from pokecon.monitor import InfoWindow, LogBuffer
+from pokecon.overlay import overlays
 from pokecon.pad import Input, Button
 from pokecon.ports import SerialSender
-from pokecon.utils import get_scripts, get_available_camera_id, get_available_ports
+from pokecon.profiler import StartupProfile
 
 
 VER = '2.0.0'
 
 
+logger = get_logger(__name__)
+
+
+# NOTE: cv2, pyaudio and pynput are imported where they are used
+#       so that the window can appear before these heavy modules are loaded
+
+
+# Opens devices and imports scripts in the background so that the window appears immediately
+# ウィンドウをすぐに表示するため、デバイスの読み込みとスクリプトのインポートはバックグラウンドで行います
+class Loader(QObject):
+    capture_loaded = Signal(object)
+    serial_loaded = Signal(bool)
+    audio_loaded = Signal(object, object)
+    scripts_loaded = Signal(object)
+    devices_loaded = Signal(object, object)
+
+    def __init__(self, config, root, profile, parent=None):
+        super().__init__(parent)
+        self.config = config
+        self.root = root
+        self.profile = profile
+
+    @staticmethod
+    def run(target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        return thread
+
+    def open_capture(self):
+        from pokecon.capture import Capture
+        with self.profile.phase('capture open'):
+            return Capture(self.config.capture.camera_id,
+                           self.config.capture.width,
+                           self.config.capture.height,
+                           self.config.capture.fps,
+                           self.root.joinpath('screenshot'))
+
+    def load_capture(self):
+        from pokecon.utils import get_available_camera_id
+        cap = None
+        # the last used device is opened without enumerating all devices
+        if self.config.capture.camera_name:
+            cap = self.open_capture()
+            if not cap.is_opened():
+                logger.warning(f'Cannot open the last used camera: {self.config.capture.camera_name}')
+                cap.release()
+                cap = None
+        if cap is None:
+            try:
+                with self.profile.phase('camera enumeration'):
+                    devices = get_available_camera_id()
+            except RuntimeError:
+                logger.error('Cannot detect camera device', exc_info=True)
+            else:
+                if self.config.capture.camera_id not in devices.keys():
+                    self.config.capture.camera_id = 0
+                self.config.capture.camera_name = devices.get(self.config.capture.camera_id, '')
+                cap = self.open_capture()
+        self.capture_loaded.emit(cap)
+
+    def load_serial(self, ser):
+        from pokecon.utils import get_available_ports
+        ok = False
+        # the last used port is opened without enumerating all ports
+        if self.config.serial.port:
+            with self.profile.phase('serial open'):
+                ok = ser.open(self.config.serial.port)
+        if not ok:
+            try:
+                with self.profile.phase('port enumeration'):
+                    ports = get_available_ports()
+            except RuntimeError:
+                logger.error('Cannot detect serial ports', exc_info=True)
+            else:
+                if self.config.serial.port not in ports:
+                    self.config.serial.port = ports[0]
+                    with self.profile.phase('serial open'):
+                        ok = ser.open(self.config.serial.port)
+        self.serial_loaded.emit(ok)
+
+    def load_audio(self):
+        from pokecon.audio import AudioPassthrough
+        from pokecon.sound import SoundDetector
+        with self.profile.phase('sounds'):
+            sound = SoundDetector(self.config.audio.rate, self.config.audio.channels)
+            # the detector is only attached when there are reference sounds
+            if sound.load():
+                sound.start()
+            else:
+                sound = None
+        audio = AudioPassthrough(self.config.audio, sound)
+        with self.profile.phase('audio init'):
+            audio.initialize()
+        if self.config.audio.volume:
+            with self.profile.phase('audio stream'):
+                audio.start()
+        self.audio_loaded.emit(audio, sound)
+
+    def load_scripts(self):
+        from pokecon.utils import get_scripts
+        scripts = {}
+        try:
+            with self.profile.phase('scripts'):
+                scripts = get_scripts()
+        except Exception as e:
+            logger.error(e, exc_info=True)
+        self.scripts_loaded.emit(scripts)
+
+    def load_devices(self):
+        from pokecon.utils import get_available_camera_id, get_available_ports
+        devices, ports = {}, []
+        with self.profile.phase('device enumeration'):
+            try:
+                devices = get_available_camera_id()
+            except RuntimeError:
+                logger.warning('Cannot detect camera device')
+            try:
+                ports = get_available_ports()
+            except RuntimeError:
+                logger.warning('Cannot detect serial ports')
+        self.devices_loaded.emit(devices, ports)
+
+
 class MouseController(QObject):
     left_pressed = Signal()
     left_released = Signal()
@@ -68,6 +197,52 @@ class MouseController(QObject):
             self.middle_released.emit()
 
 
+# Requests of the control API, start and stop are emitted from the server threads
+# and handled on the GUI thread
+class ControlBridge(QObject):
+    start_requested = Signal(str)
+    stop_requested = Signal()
+
+    def __init__(self, window, parent=None):
+        super().__init__(parent)
+        self.window = window
+        # widgets are only read on the GUI thread, the selected script is kept here for status()
+        self.script = window.combobox_command.currentText()
+        # a start request is pending until the GUI thread handles it
+        self.starting = False
+
+    def scripts(self):
+        return list(self.window.scripts.keys())
+
+    def is_playing(self):
+        return self.window.is_playing or self.starting
+
+    def input(self):
+        return self.window.input
+
+    @Slot(str)
+    def set_script(self, name):
+        self.script = name
+
+    def start_script(self, name):
+        self.starting = True
+        self.start_requested.emit(name)
+
+    def stop_script(self):
+        self.stop_requested.emit()
+
+    def status(self):
+        window, cap, script = self.window, self.window.cap, self.window.current_script
+        return {
+            'playing': window.is_playing,
+            'script': self.script,
+            'stats': script.stats_text() if window.is_playing and script is not None else '',
+            'serial': window.ser.is_open(),
+            'capture': cap is not None,
+            'frame_id': cap.frame_id if cap is not None else None,
+        }
+
+
 class QVideoLabel(QLabel):
 
     def __init__(self, parent=None):
@@ -84,14 +259,18 @@ class QVideoLabel(QLabel):
 
 
 class Window(QMainWindow):
-    def __init__(self, root, parent=None):
+    def __init__(self, root, profile=None, parent=None):
         super().__init__(parent)
         # unique settings
         # path
         self.root = root
+        # startup profile
+        self.profile = profile if profile is not None else StartupProfile()
         # conf
-        self.config = Config()
-        self.config.read()
+        with self.profile.phase('config'):
+            self.config = Config()
+            self.config.read()
+        widgets_start = perf_counter()
         # status bar
         self.statusBar().setContentsMargins(16, 0, 0, 0)
         # history
@@ -116,35 +295,48 @@ class Window(QMainWindow):
         self.button_settings.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
         self.statusBar().addPermanentWidget(self.button_settings)
         # log
-        self.logger = logging.getLogger()
-        formatter = logging.Formatter(' %(asctime)s [%(levelname)s] %(name)s: %(message)s')
-        self.signal_handler = SignalHandler()
-        self.signal_handler.setFormatter(formatter)
-        self.signal_handler.setLevel(logging.INFO)
-        self.signal_handler.emitter.message.connect(self.write)
-        self.logger.addHandler(self.signal_handler)
+        self.formatter = logging.Formatter(' %(asctime)s [%(levelname)s] %(name)s: %(message)s')
+        self.log_buffer = LogBuffer()
+        self.log_buffer.setLevel(logging.INFO)
+        add_handler(self.log_buffer)
         self.info_window = InfoWindow(self)
-        # capture
-        self.cap_devices = get_available_camera_id()
-        if self.config.capture.camera_id not in self.cap_devices.keys():
-            self.config.capture.camera_id = 0
-        self.cap = Capture(self.config.capture.camera_id,
-                           self.config.capture.width,
-                           self.config.capture.height,
-                           self.config.capture.fps,
-                           self.root.joinpath('screenshot'))
-        # serial
-        self.ports = get_available_ports()
-        if self.config.serial.port not in self.ports:
-            self.config.serial.port = self.ports[0]
+        self.log_timer = QTimer()
+        self.log_timer.timeout.connect(self.flush_log)
+        self.log_timer.start(200)
+        # capture (opened by the loader)
+        self.cap = None
+        self.frame_bus = None
+        self.preview = None
+        # reused by scale_frame
+        self.display_buffer = None
+        self.display_image = None
+        self.display_pixmap = None
+        self.cap_devices = {}
+        if self.config.capture.camera_name:
+            self.cap_devices[self.config.capture.camera_id] = self.config.capture.camera_name
+        # serial (opened by the loader)
+        self.ports = [self.config.serial.port] if self.config.serial.port else []
         self.ser = SerialSender()
-        self.ser.open(self.config.serial.port)
         # keyboard
         self.input = Input(self.ser)
         self.keyboard = None
-        # scripts
-        self.scripts = get_scripts()
+        # scripts (imported by the loader)
+        self.scripts = {}
         self.current_script = None
+        # audio (initialized by the loader)
+        self.audio = None
+        self.sound = None
+        # metrics endpoint
+        self.metrics_server = None
+        if self.config.metrics.enabled:
+            try:
+                self.metrics_server = metrics.MetricsServer(self.config.metrics.port)
+                self.metrics_server.start()
+            except OSError:
+                logger.error('Metrics: cannot listen on the port', exc_info=True)
+        # control API (started once the widgets exist)
+        self.control = None
+        self.control_bridge = None
         # settings
         self.screen_rect = QApplication.primaryScreen().geometry()
         if self.screen_rect.width() <= 1920:
@@ -174,7 +366,7 @@ class Window(QMainWindow):
         self.group_image.setSizePolicy(QSizePolicy.Preferred, QSizePolicy.Fixed)
         image_layout = QHBoxLayout()
         self.buttons_image = {}
-        for key in ['save', 'open']:
+        for key in ['save', 'open', 'record']:
             self.buttons_image[key] = QPushButton(key)
             self.buttons_image[key].setSizePolicy(QSizePolicy.Preferred, QSizePolicy.Fixed)
             image_layout.addWidget(self.buttons_image[key], 1)
@@ -185,8 +377,6 @@ class Window(QMainWindow):
         self.group_command.setSizePolicy(QSizePolicy.Preferred, QSizePolicy.Fixed)
         command_layout = QHBoxLayout()
         self.combobox_command = QComboBox()
-        for key in self.scripts.keys():
-            self.combobox_command.addItem(key)
         command_layout.addWidget(self.combobox_command, 2)
         self.buttons_command = {}
         for key in ['start/stop', 'reload']:
@@ -196,6 +386,12 @@ class Window(QMainWindow):
         self.buttons_command['start/stop'].setText('start')
         self.group_command.setLayout(command_layout)
 
+        # disabled until the loader finishes
+        self.buttons_image['save'].setEnabled(False)
+        self.buttons_image['record'].setEnabled(False)
+        self.buttons_command['start/stop'].setEnabled(False)
+        self.buttons_command['reload'].setEnabled(False)
+
         # top layout
         top_layout = QHBoxLayout()
         top_layout.addWidget(self.label_video, alignment=Qt.AlignCenter)
@@ -216,8 +412,9 @@ class Window(QMainWindow):
         self.setCentralWidget(self.widget)
 
         # connections
-        self.buttons_image['save'].clicked.connect(self.cap.screenshot)
+        self.buttons_image['save'].clicked.connect(self.screenshot)
         self.buttons_image['open'].clicked.connect(self.open_dir)
+        self.buttons_image['record'].clicked.connect(self.record)
         self.combobox_command.currentTextChanged.connect(self.set_current_script)
         self.buttons_command['reload'].clicked.connect(self.reload_scrips)
         self.buttons_command['start/stop'].clicked.connect(self.command)
@@ -239,27 +436,147 @@ class Window(QMainWindow):
         self.video_timer.timeout.connect(self.next_frame)
         self.video_timer.start(millisecond)
 
-        # audio
-        self.p = pyaudio.PyAudio()
-        if self.config.audio.volume:
-            self.start_audio()
-        else:
-            self.stream = None
+        # script stats
+        self.stats_timer = QTimer()
+        self.stats_timer.timeout.connect(self.show_stats)
+        self.stats_timer.start(1000)
 
         # flag
         self.is_playing = False
         self.is_loaded = False
+        self.is_shown = False
+        self.is_enumerated = False
         self.other_width = self.size().width() - self.label_video.size().width()
         self.other_height = self.size().height() - self.label_video.size().height()
+        self.profile.add('widgets', widgets_start, perf_counter())
+
+        # the bridge reads the command combobox and the flags above
+        if self.config.control.enabled:
+            self.start_control()
+
+        # loader
+        self.loading = 4
+        self.loader = Loader(self.config, self.root, self.profile)
+        self.loader.capture_loaded.connect(self.on_capture_loaded)
+        self.loader.serial_loaded.connect(self.on_serial_loaded)
+        self.loader.audio_loaded.connect(self.on_audio_loaded)
+        self.loader.scripts_loaded.connect(self.on_scripts_loaded)
+        self.loader.devices_loaded.connect(self.on_devices_loaded)
+        self.loader.run(self.loader.load_capture)
+        self.loader.run(self.loader.load_serial, self.ser)
+        self.loader.run(self.loader.load_audio)
+        self.loader.run(self.loader.load_scripts)
+
+    def loaded(self):
+        self.loading -= 1
+        if self.loading == 0:
+            self.profile.mark('ready')
+            self.profile.report()
+
+    @Slot(object)
+    def on_capture_loaded(self, cap):
+        self.cap = cap
+        metrics.capture_source = cap
+        if cap is not None:
+            self.cap_devices.setdefault(self.config.capture.camera_id, self.config.capture.camera_name)
+            self.settings_window.set_devices(self.cap_devices, self.ports)
+            self.buttons_image['save'].setEnabled(True)
+            self.buttons_image['record'].setEnabled(True)
+            if self.config.capture.frame_bus or self.config.app.script_process:
+                from pokecon.framebus import FrameBusPublisher
+                self.frame_bus = FrameBusPublisher(self.config.capture.frame_bus or f'pokecon_{os.getpid()}')
+                cap.add_sink(self.frame_bus.publish)
+            if self.config.preview.enabled:
+                self.start_preview(cap)
+            # scripts created before the capture was opened need it
+            if not self.is_playing:
+                self.set_current_script(self.combobox_command.currentText())
+        self.loaded()
+
+    @Slot(bool)
+    def on_serial_loaded(self, ok):
+        if ok and self.config.serial.port not in self.ports:
+            self.ports.append(self.config.serial.port)
+            self.settings_window.set_devices(self.cap_devices, self.ports)
+        self.loaded()
+
+    @Slot(object, object)
+    def on_audio_loaded(self, audio, sound):
+        self.audio = audio
+        self.sound = sound
+        self.loaded()
+
+    @Slot(object)
+    def on_scripts_loaded(self, scripts):
+        self.scripts = scripts
+        for key in self.scripts.keys():
+            self.combobox_command.addItem(key)
+        self.buttons_command['start/stop'].setEnabled(True)
+        self.buttons_command['reload'].setEnabled(True)
+        self.loaded()
+
+    def enumerate_devices(self):
+        if not self.is_enumerated:
+            self.is_enumerated = True
+            self.loader.run(self.loader.load_devices)
+
+    @Slot(object, object)
+    def on_devices_loaded(self, devices, ports):
+        self.cap_devices = devices
+        self.ports = ports
+        self.settings_window.set_devices(self.cap_devices, self.ports)
+
+    def screenshot(self):
+        if self.cap is not None:
+            self.cap.screenshot()
 
     def next_frame(self):
-        ret, frame = self.cap.read()
+        if self.cap is None:
+            return
+        # the pooled buffer is only kept until the frame is scaled, so there is no copy
+        ret, buffer = self.cap.read_buffer()
         if ret:
-            img = QImage(frame, frame.shape[1], frame.shape[0], QImage.Format_BGR888)
-            pix = QPixmap.fromImage(img)
-            pix = pix.scaled(self.label_video.width(), self.label_video.height(),
-                             Qt.KeepAspectRatio, Qt.SmoothTransformation)  # 負荷
+            try:
+                frame = buffer.array
+                pix = self.scale_frame(frame)
+            finally:
+                buffer.release()
+            # overlays are only rendered while someone can see them
+            if self.label_video.isVisible() and not self.isMinimized():
+                active = overlays.active()
+                if active:
+                    self.draw_overlays(pix, active, pix.width() / frame.shape[1])
             self.label_video.setPixmap(pix)
+            metrics.display_frames.inc()
+            metrics.display_fps.tick()
+
+    # Scale the frame into a reused buffer with cv2 (which releases the GIL) and upload only the
+    # scaled image, instead of converting the full frame and scaling a new QPixmap every frame
+    def scale_frame(self, frame):
+        import cv2
+        import numpy as np
+        h, w = frame.shape[:2]
+        scale = min(self.label_video.width() / w, self.label_video.height() / h)
+        size = (max(int(w * scale), 1), max(int(h * scale), 1))
+        if self.display_buffer is None or self.display_buffer.shape[:2] != (size[1], size[0]):
+            self.display_buffer = np.empty((size[1], size[0], 3), np.uint8)
+            self.display_image = QImage(self.display_buffer.data, size[0], size[1], size[0] * 3,
+                                        QImage.Format_BGR888)
+            self.display_pixmap = QPixmap(size[0], size[1])
+        cv2.resize(frame, size, dst=self.display_buffer,
+                   interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+        self.display_pixmap.convertFromImage(self.display_image)
+        return self.display_pixmap
+
+    @staticmethod
+    def draw_overlays(pix, active, scale):
+        painter = QPainter(pix)
+        painter.setPen(QPen(QColor(255, 0, 255), 2))
+        for o in active:
+            x, y, w, h = [int(v * scale) for v in o.rect]
+            painter.drawRect(x, y, w, h)
+            painter.drawText(x, max(y - 4, 12), f'{o.label} {o.score:.2f} #{o.frame_id}')
+        painter.end()
 
     def left_mouse_press(self):
         if not self.is_playing:
@@ -289,19 +606,85 @@ class Window(QMainWindow):
     def write(self, msg):
         self.statusBar().showMessage(msg)
 
+    # only the last record is shown in the status bar, the log window gets the whole batch
+    def flush_log(self):
+        records = self.log_buffer.drain()
+        if records:
+            self.write(self.formatter.format(records[-1]))
+            self.info_window.write(records)
+
+    def record(self):
+        if self.cap.is_recording():
+            self.cap.stop_recording()
+            self.buttons_image['record'].setText('record')
+        else:
+            filename = f'session_{datetime.datetime.now():%Y%m%d%H%M%S}.pca'
+            self.cap.start_recording(self.root.joinpath('recordings', filename), **vars(self.config.record))
+            self.buttons_image['record'].setText('stop')
+
     def open_dir(self):
         QDesktopServices.openUrl(QUrl(f'file:///{self.root.joinpath("screenshot")}'))
 
+    def start_preview(self, cap):
+        from pokecon.preview import PreviewServer
+        config = self.config.preview
+        try:
+            self.preview = PreviewServer(config.port, config.width, config.quality, config.fps)
+        except OSError:
+            logger.error('Preview: cannot listen on the port', exc_info=True)
+            return
+        self.preview.start()
+        cap.add_sink(self.preview.publish)
+
+    def start_control(self):
+        from pokecon.control import ControlServer
+        self.control_bridge = ControlBridge(self)
+        self.control_bridge.start_requested.connect(self.on_control_start)
+        self.control_bridge.stop_requested.connect(self.on_control_stop)
+        self.combobox_command.currentTextChanged.connect(self.control_bridge.set_script)
+        try:
+            self.control = ControlServer(self.control_bridge, self.config.control.port)
+        except OSError:
+            logger.error('Control: cannot listen on the port', exc_info=True)
+            return
+        self.control.start()
+
+    @Slot(str)
+    def on_control_start(self, name):
+        try:
+            if self.is_playing or name not in self.scripts:
+                return
+            self.combobox_command.setCurrentText(name)
+            self.command_pre_process()
+            self.start_command()
+        finally:
+            self.control_bridge.starting = False
+
+    @Slot()
+    def on_control_stop(self):
+        if self.is_playing and self.current_script is not None:
+            self.stop_command()
+
+    def create_script(self, cls_):
+        from pokecon.command import ImageProcPythonCommand, PythonCommand
+        if self.config.app.script_process and issubclass(cls_, PythonCommand):
+            from pokecon.isolation import ProcessCommand
+            return ProcessCommand(cls_, self.frame_bus.name if self.frame_bus is not None else None)
+        if issubclass(cls_, ImageProcPythonCommand):
+            return cls_(self.cap)
+        else:
+            return cls_()
+
     def set_current_script(self, key):
         if key:
-            cls_ = self.scripts[key]
-            if issubclass(cls_, ImageProcPythonCommand):
-                self.current_script = cls_(self.cap)
-            else:
-                self.current_script = cls_()
+            self.current_script = self.create_script(self.scripts[key])
 
     def reload_scrips(self):
+        from pokecon.template import templates
+        from pokecon.utils import get_scripts
         self.buttons_command['reload'].setEnabled(False)
+        # edited or added templates are read again, the atlas is rebuilt on the next use if a PNG changed
+        templates.clear()
         before = self.combobox_command.currentText()
         self.combobox_command.clear()
         self.scripts = get_scripts(old=list(self.scripts.keys()))
@@ -325,17 +708,12 @@ class Window(QMainWindow):
         self.is_playing = True
         if self.current_script is None:
             key = self.combobox_command.currentText()
-            cls = self.scripts[key]
-            if issubclass(cls, ImageProcPythonCommand):
-                self.current_script = cls(self.cap)
-            else:
-                self.current_script = cls()
-        self.current_script.start(self.ser, self.command_post_process)
+            self.current_script = self.create_script(self.scripts[key])
+        self.current_script.start(self.ser, self.command_post_process, self.sound)
 
     def command_pre_process(self):
         if self.keyboard is not None:
-            self.keyboard.stop()
-            self.keyboard = None
+            self.keyboard.disable()
         self.is_playing = True
         self.settings_window.combobox_video.setEnabled(False)
         self.settings_window.combobox_ports.setEnabled(False)
@@ -350,29 +728,27 @@ class Window(QMainWindow):
         self.buttons_command['reload'].setEnabled(True)
         self.buttons_command['start/stop'].setText('start')
         self.is_playing = False
-        if self.keyboard is None and (self.hasFocus() or self.isActiveWindow()):
-            self.keyboard = KeyboardController(self.input)
-            self.keyboard.start()
+        if self.keyboard is not None and (self.hasFocus() or self.isActiveWindow()):
+            self.keyboard.enable()
         self.current_script = None
 
+    def show_stats(self):
+        script = self.current_script
+        if self.is_playing and script is not None:
+            self.statusBar().showMessage(script.stats_text())
+
     def stop_command(self):
         self.current_script.end()
 
     def start_audio(self):
-        self.stream = self.p.open(
-            format=pyaudio.paInt16,
-            channels=2,
-            rate=44100,
-            input=True,
-            output=True,
-            stream_callback=lambda input_data, c, t, s: (input_data, pyaudio.paContinue)
-        )
-        self.stream.start_stream()
+        self.audio.start()
 
     def switch_volume(self):
+        # PyAudio is still being initialized by the loader
+        if self.audio is None:
+            return
         if self.config.audio.volume:
-            self.stream.stop_stream()
-            self.stream.close()
+            self.audio.stop()
             self.button_volume.setIcon(QIcon(str(self.root.joinpath('assets/volume_off.png'))))
             self.config.audio.volume = False
         else:
@@ -422,15 +798,24 @@ class Window(QMainWindow):
 
     def event(self, event):
         if event.type() == QEvent.WindowActivate or event.type() == QEvent.FocusIn:
-            if not self.is_playing:
-                self.keyboard = KeyboardController(self.input)
+            # one listener is kept for the whole session and gated by the focus
+            if self.keyboard is None:
+                from pokecon.keybord import KeyboardController, load_key_map
+                self.keyboard = KeyboardController(self.input, load_key_map(self.config.keyboard))
                 self.keyboard.start()
+            if not self.is_playing:
+                self.keyboard.enable()
         elif event.type() == QEvent.WindowDeactivate or event.type() == QEvent.FocusOut:
             if self.keyboard is not None:
-                self.keyboard.stop()
-                self.keyboard = None
+                self.keyboard.disable()
         return super().event(event)
 
+    def showEvent(self, event):
+        if not self.is_shown:
+            self.is_shown = True
+            self.profile.mark('window shown')
+        super().showEvent(event)
+
     def resizeEvent(self, event) -> None:
         if not self.is_loaded:
             super().resizeEvent(event)
@@ -448,12 +833,29 @@ class Window(QMainWindow):
             super().resizeEvent(event)
 
     def closeEvent(self, event):
-        self.ser.close()
+        if self.ser.is_open():
+            self.ser.close()
         self.video_timer.stop()
-        self.cap.release()
-        self.stream.stop_stream()
-        self.stream.close()
-        self.p.terminate()
+        self.log_timer.stop()
+        self.stats_timer.stop()
+        remove_handler(self.log_buffer)
+        if self.keyboard is not None:
+            self.keyboard.stop()
+            self.keyboard.report()
+        if self.cap is not None:
+            self.cap.release()
+        if self.frame_bus is not None:
+            self.frame_bus.close()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        if self.preview is not None:
+            self.preview.stop()
+        if self.control is not None:
+            self.control.stop()
+        if self.audio is not None:
+            self.audio.terminate()
+        if self.sound is not None:
+            self.sound.stop()
         self.info_window.close()
         self.settings_window.close()
         self.config.write()
@@ -523,6 +925,21 @@ class SettingsWindow(QWidget):
 
         self.combobox_display.currentTextChanged.connect(self.parent().set_display_size)
 
+    def set_devices(self, cap_devices, ports):
+        self.combobox_video.clear()
+        for key in cap_devices.values():
+            self.combobox_video.addItem(key)
+        self.combobox_video.setCurrentText(cap_devices.get(self.parent().config.capture.camera_id, ''))
+        self.combobox_ports.clear()
+        for key in ports:
+            self.combobox_ports.addItem(key)
+        self.combobox_ports.setCurrentText(self.parent().config.serial.port)
+
+    def showEvent(self, event) -> None:
+        # all devices are enumerated only when someone wants to choose one
+        self.parent().enumerate_devices()
+        super().showEvent(event)
+
     def closeEvent(self, event) -> None:
         if self.parent().screen_rect.width() <= 1920:
             self.parent().move_center()
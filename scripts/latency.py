@@ -0,0 +1,60 @@
+from pokecon.command import ImageProcPythonCommand
+from pokecon.latency import ChangeProbe, Latency, save_latency
+from pokecon.logger import get_logger
+from pokecon.pad import Button
+
+
+logger = get_logger(__name__)
+
+
+# Measure the time from a serial write to a visible change in the captured frames.
+# BUTTON must change AREA every time it is pressed, e.g. a button which opens and closes a menu
+# 入力から画面が変化するまでの時間を測定し、conf/latency.iniに保存します
+# (押すたびにAREAが変化するボタン、例えばメニューを開閉するボタンを指定してください)
+class MeasureLatency(ImageProcPythonCommand):
+	NAME = '遅延測定'
+	BUTTON = Button.X
+	# [x1, x2, y1, y2] at 1920x1080, None for the whole screen
+	AREA = None
+	REPEAT = 20
+	# mean absolute difference (0 to 255) counted as a change
+	THRESHOLD = 10.0
+	# seconds to wait for the screen to settle after each change
+	SETTLE = 1.5
+	TIMEOUT = 2.0
+
+	def __init__(self, cap):
+		super().__init__(cap)
+
+	def do(self):
+		probe = ChangeProbe(self.AREA, self.THRESHOLD)
+		self.add_probe(probe)
+		try:
+			latencies = self.measure(probe)
+		finally:
+			self.remove_probe(probe)
+		if not latencies:
+			logger.error('no change was seen, check BUTTON, AREA and THRESHOLD')
+			return
+		latency = Latency.of(latencies, self.cap.fps)
+		save_latency(latency)
+		logger.info(f'latency of {len(latencies)} presses: {latency.text()}')
+
+	def measure(self, probe):
+		latencies = []
+		self.wait(self.SETTLE)
+		for i in range(self.REPEAT):
+			if not self.arm_probe(probe):
+				logger.error('no frame is read from the capture')
+				break
+			self.input.press(self.BUTTON)
+			written = self.clock.time()
+			hit = self.wait_probe(probe, self.TIMEOUT)
+			self.input.press_end(self.BUTTON)
+			if hit is None:
+				logger.warning(f'{i + 1}/{self.REPEAT}: no change within {self.TIMEOUT} s')
+			else:
+				latencies.append(hit[1] - written)
+				logger.info(f'{i + 1}/{self.REPEAT}: {(hit[1] - written) * 1000:.1f} ms (frame {hit[0]})')
+			self.wait(self.SETTLE)
+		return latencies
@@ -0,0 +1,18 @@
+import cv2
+import numpy as np
+
+from pokecon.replay import ReplayCapture
+
+
+def test_screenshot_of_replay(tmp_path):
+    frames = tmp_path.joinpath('frames')
+    frames.mkdir()
+    image = np.full((36, 64, 3), (10, 20, 30), np.uint8)
+    cv2.imwrite(str(frames.joinpath('0000.png')), image)
+    cap = ReplayCapture(frames, mode=ReplayCapture.FAST, path_dir=tmp_path.joinpath('screenshot'))
+
+    assert cap.screenshot() is None
+    ref, frame = cap.read()
+    assert ref
+    path = cap.screenshot()
+    assert np.array_equal(cv2.imread(str(path)), image)
@@ -0,0 +1,49 @@
+import json
+import os
+from pathlib import Path
+from urllib.request import urlopen
+
+import pytest
+
+pytest.importorskip('PySide2')
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+
+from PySide2.QtWidgets import QApplication  # noqa: E402
+
+from pokecon.command import PythonCommand  # noqa: E402
+from pokecon.config import Config  # noqa: E402
+from pokecon.window import Loader, Window  # noqa: E402
+
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+class MashA(PythonCommand):
+    NAME = 'A連打'
+
+
+def test_window_with_control(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    read = Config.read
+
+    def read_with_control(self):
+        read(self)
+        self.control.enabled = True
+        self.control.port = 0
+
+    monkeypatch.setattr(Config, 'read', read_with_control)
+    # no devices nor scripts are loaded
+    monkeypatch.setattr(Loader, 'run', staticmethod(lambda target, *args: None))
+    app = QApplication.instance() or QApplication([])
+    window = Window(ROOT)
+    try:
+        assert window.control is not None
+        window.on_scripts_loaded({MashA.NAME: MashA})
+        host, port = window.control.server.server_address[:2]
+        with urlopen(f'http://{host}:{port}/status') as response:
+            status = json.load(response)
+        assert status['script'] == 'A連打'
+        assert not status['playing']
+    finally:
+        window.close()
+        app.processEvents()